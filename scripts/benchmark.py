@@ -0,0 +1,386 @@
+"""
+Micro-benchmarks of the hot spots of the PyTorch model.
+
+    python scripts/benchmark.py cdna --device cuda --batch_sizes 4 16 32
+    python scripts/benchmark.py import --max_seconds 1.0
+    python scripts/benchmark.py tile_concat --device cuda --batch_size 16
+    python scripts/benchmark.py --device cpu amp --precisions fp32 bf16
+    python scripts/benchmark.py checkpoint --policies none blocks steps:1 steps:2 --sequence_length 12
+    python scripts/benchmark.py --device cpu unroll --sequence_lengths 12 30 --batch_size 8
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def timeit(fn, device, num_iters=20, num_warmup=3):
+    for _ in range(num_warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for _ in range(num_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time) / num_iters
+
+
+def apply_cdna_kernels_loop(images, kernels):
+    """
+    The original per-sample implementation of `apply_cdna_kernels`, kept as
+    the reference for the benchmark. Only supports 5x5 kernels.
+    """
+    batch_size, color_channels, height, width = images.shape
+    batch_size, kernel_height, kernel_width, num_transformed_images = kernels.shape
+    images = images.permute([1, 0, 2, 3])
+    kernels = kernels.permute([3, 0, 1, 2])
+    images = torch.chunk(images, batch_size, dim=1)
+    kernels = torch.chunk(kernels, batch_size, dim=1)
+    outputs = []
+    for img, k in zip(images, kernels):
+        outputs.append(F.conv2d(input=img, weight=k, padding=2))
+    outputs = torch.cat(outputs, dim=0)
+    outputs = outputs.reshape([batch_size, color_channels, num_transformed_images, height, width])
+    outputs = outputs.permute([2, 0, 1, 3, 4])
+    return [output.squeeze(0) for output in torch.split(outputs, 1, dim=0)]
+
+
+def bench_cdna(args):
+    from video_prediction.models.savp_model import apply_cdna_kernels
+
+    device = torch.device(args.device)
+    height, width = args.image_size
+    print('%10s %12s %12s %8s' % ('batch_size', 'loop (ms)', 'grouped (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        images = torch.rand([batch_size, 3, height, width], device=device)
+        kernels = torch.rand([batch_size, 5, 5, args.num_transformed_images], device=device)
+        with torch.no_grad():
+            expected = torch.stack(apply_cdna_kernels_loop(images, kernels), dim=1)
+            actual = apply_cdna_kernels(images, kernels)
+            assert torch.allclose(expected, actual, atol=1e-4), 'apply_cdna_kernels does not match the reference'
+            loop_time = timeit(lambda: apply_cdna_kernels_loop(images, kernels), device, args.num_iters)
+            grouped_time = timeit(lambda: apply_cdna_kernels(images, kernels), device, args.num_iters)
+        print('%10d %12.3f %12.3f %7.2fx' % (batch_size, loop_time * 1000, grouped_time * 1000,
+                                             loop_time / grouped_time))
+
+
+def bench_tile_concat(args):
+    """
+    Conv over feature maps concatenated with a spatially tiled z, forward
+    and backward: `repeat` copies (the original tile_concat), `expand` views
+    read by torch.cat, and z folded into the conv (fold_z_into_conv).
+    """
+    import torch.nn as nn
+    from video_prediction.utils.util import conv2d_tile_concat, tile_concat
+
+    device = torch.device(args.device)
+
+    def repeat_concat(h, z):
+        return torch.cat([h, z[:, :, None, None].repeat([1, 1] + list(h.shape[2:]))], dim=1)
+
+    print('%6s %8s %10s %12s %12s %12s' % ('size', 'channels', 'nz', 'repeat (ms)', 'expand (ms)', 'fold (ms)'))
+    for size, channels in zip(args.sizes, args.channels):
+        conv = nn.Conv2d(channels + args.nz, channels, kernel_size=3, padding=1).to(device)
+        h = torch.rand([args.batch_size, channels, size, size], device=device, requires_grad=True)
+        z = torch.rand([args.batch_size, args.nz], device=device, requires_grad=True)
+        fns = [lambda: conv(repeat_concat(h, z)),
+               lambda: conv(tile_concat([h, z[:, :, None, None]], axis=1)),
+               lambda: conv2d_tile_concat(conv, h, z, z_start=channels)]
+        with torch.no_grad():
+            expected = fns[0]()
+            assert all(torch.allclose(expected, fn(), atol=1e-4) for fn in fns[1:]), 'z folding does not match'
+        times = [timeit(lambda: fn().sum().backward(), device, args.num_iters) for fn in fns]
+        print('%6d %8d %10d %12.3f %12.3f %12.3f' % ((size, channels, args.nz) + tuple(t * 1000 for t in times)))
+
+
+def build_savp_model(args, **hparams_dict):
+    from video_prediction.models.savp_model import SAVPModel
+
+    hparams = dict(context_frames=args.context_frames, sequence_length=args.sequence_length,
+                   ngf=args.ngf, ndf=args.ndf, nef=args.nef, num_samples=args.num_samples)
+    hparams.update(hparams_dict)
+    height, width = args.image_size
+    input_shape = [args.batch_size, args.sequence_length, height, width, 3]
+    model = SAVPModel(input_shape, 'train', hparams_dict=hparams, device=args.device)
+    images = torch.randint(0, 256, input_shape, dtype=torch.uint8)
+    return model, images
+
+
+def savp_train_step_fn(model, images):
+    """
+    Returns a function running one `SAVPModel.train_step`, i.e. one
+    discriminator and generator update with a shared `GradScaler`.
+    """
+    g_optimizer, d_optimizer = model.make_optimizers()
+    scaler = model.grad_scaler()
+
+    def train_step():
+        model.train_step({'images': images}, g_optimizer, d_optimizer, scaler, step=0)
+    return train_step
+
+
+def peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_savp_workers(args, benchmark, worker_args):
+    """
+    Runs `benchmark --worker` once per entry of `worker_args` in a fresh
+    process, so that the peak RSS of CPU runs is not shared, and returns the
+    json results of the workers.
+    """
+    results = []
+    for extra_args in worker_args:
+        cmd = [sys.executable, os.path.abspath(__file__), '--device', args.device, '--num_iters', str(args.num_iters),
+               benchmark, '--worker'] + extra_args
+        for name in ['batch_size', 'sequence_length', 'context_frames', 'ngf', 'ndf', 'nef', 'num_samples']:
+            cmd += ['--' + name, str(getattr(args, name))]
+        cmd += ['--image_size'] + [str(size) for size in args.image_size]
+        if args.disable_mkldnn:
+            cmd += ['--disable_mkldnn']
+        output = subprocess.check_output(cmd)
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    return results
+
+
+def bench_savp_worker(args, **hparams_dict):
+    device = torch.device(args.device)
+    model, images = build_savp_model(args, **hparams_dict)
+    train_step = savp_train_step_fn(model, images)
+    step_time = timeit(train_step, device, args.num_iters, num_warmup=1)
+    print(json.dumps({'step_time': step_time, 'peak_memory': peak_memory(device)}))
+
+
+def print_savp_results(name, configs, results):
+    print('%12s %15s %10s %17s %10s' % (name, 'step time (s)', 'speedup', 'peak memory (MB)', 'ratio'))
+    base = results[0]
+    for config, result in zip(configs, results):
+        print('%12s %15.3f %9.2fx %17.1f %10.2f' % (config, result['step_time'], base['step_time'] / result['step_time'],
+                                                 result['peak_memory'] / 2 ** 20,
+                                                 result['peak_memory'] / float(base['peak_memory'])))
+
+
+def bench_amp(args):
+    """
+    Training step time and peak memory of each precision.
+    """
+    if args.disable_mkldnn:
+        torch.backends.mkldnn.enabled = False
+    if args.worker:
+        bench_savp_worker(args, precision=args.precisions[0])
+        return
+    results = run_savp_workers(args, 'amp', [['--precisions', precision] for precision in args.precisions])
+    print_savp_results('precision', args.precisions, results)
+
+
+def bench_checkpoint(args):
+    """
+    Training step time and peak memory of each activation checkpointing
+    policy, given as `none`, `blocks` or `steps:<checkpoint_every>`.
+    """
+    if args.disable_mkldnn:
+        torch.backends.mkldnn.enabled = False
+    if args.worker:
+        policy, _, every = args.policies[0].partition(':')
+        bench_savp_worker(args, checkpoint_policy=policy, checkpoint_every=int(every or 1))
+        return
+    results = run_savp_workers(args, 'checkpoint', [['--policies', policy] for policy in args.policies])
+    print_savp_results('policy', args.policies, results)
+
+
+def bench_eval(args):
+    """
+    Time and peak memory of the best-of-N evaluation for each
+    `<eval_num_samples>:<eval_parallel_iterations>`. The peak memory only
+    depends on the number of samples drawn at once.
+    """
+    if args.disable_mkldnn:
+        torch.backends.mkldnn.enabled = False
+    if args.worker:
+        from video_prediction.utils import util
+
+        device = torch.device(args.device)
+        num_samples, parallel_iterations = [int(value) for value in args.configs[0].split(':')]
+        model, images = build_savp_model(args)
+        model.eval()
+        inputs = {'images': util.preprocess_images(images, device)}
+
+        def eval_fn():
+            model.eval_outputs_and_metrics_fn(inputs, num_samples=num_samples,
+                                              parallel_iterations=parallel_iterations)
+        eval_time = timeit(eval_fn, device, args.num_iters, num_warmup=1)
+        print(json.dumps({'step_time': eval_time, 'peak_memory': peak_memory(device)}))
+        return
+    results = run_savp_workers(args, 'eval', [['--configs', config] for config in args.configs])
+    print_savp_results('samples:par', args.configs, results)
+
+
+def unroll_buffer_reference(generator, inputs):
+    """
+    `GeneratorGivenZ.forward` writing each step into preallocated (T, N, ...)
+    buffers instead of stacking the outputs, kept as the reference for the
+    benchmark. Every slice write adds a CopySlices node that copies the
+    whole buffer in backward.
+    """
+    images = inputs['images']
+    states = generator.state_arena.initial_states(images.shape[1], images.device, images.dtype)
+    states['last_images'] = [images[0]] * generator.hparams.last_frames
+    step_outputs, _ = generator.unroll(inputs, states, images, 0, generator.time_length)
+    outputs = {k: v.new_empty([generator.time_length] + list(v.shape)) for k, v in step_outputs[0].items()}
+    for i, output in enumerate(step_outputs):
+        for k, v in output.items():
+            outputs[k][i] = v
+    return outputs
+
+
+def bench_unroll(args):
+    """
+    Forward and backward time of the unroll of the generator for each
+    sequence length: the per-step outputs written into preallocated buffers
+    against stacked once at the end (`GeneratorGivenZ.forward`).
+    """
+    device = torch.device(args.device)
+    print('%16s %12s %12s %8s' % ('sequence_length', 'buffer (s)', 'stack (s)', 'speedup'))
+    for sequence_length in args.sequence_lengths:
+        args.sequence_length = sequence_length
+        model, _ = build_savp_model(args)
+        generator = model.generator.generator
+        height, width = args.image_size
+        time_length = sequence_length - 1
+        inputs = {'images': torch.rand([time_length, args.batch_size, 3, height, width], device=device),
+                  'zs': torch.randn([time_length, args.batch_size, model.hparams.nz], device=device)}
+        with torch.no_grad():
+            expected = unroll_buffer_reference(generator, inputs)['gen_images']
+            actual = generator(inputs)['gen_images']
+            assert torch.allclose(expected, actual, atol=1e-5), 'the stacked outputs do not match the reference'
+
+        def backward(fn):
+            generator.zero_grad(set_to_none=True)
+            fn(generator, inputs)['gen_images'].sum().backward()
+        buffer_time = timeit(lambda: backward(unroll_buffer_reference), device, args.num_iters, num_warmup=1)
+        stack_time = timeit(lambda: backward(type(generator).__call__), device, args.num_iters, num_warmup=1)
+        print('%16d %12.3f %12.3f %7.2fx' % (sequence_length, buffer_time, stack_time, buffer_time / stack_time))
+
+
+def add_savp_arguments(parser):
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--image_size", type=int, nargs=2, default=[160, 320])
+    parser.add_argument("--sequence_length", type=int, default=6)
+    parser.add_argument("--context_frames", type=int, default=2)
+    parser.add_argument("--ngf", type=int, default=32)
+    parser.add_argument("--ndf", type=int, default=32)
+    parser.add_argument("--nef", type=int, default=32)
+    parser.add_argument("--num_samples", type=int, default=2)
+    parser.add_argument("--disable_mkldnn", action='store_true',
+                        help="work around oneDNN crashes in the bf16 conv3d backward of some CPU builds")
+    parser.add_argument("--worker", action='store_true', help=argparse.SUPPRESS)
+
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start_time = time.time()
+import torch
+torch_time = time.time() - start_time
+for module in sys.argv[1:]:
+    __import__(module)
+total_time = time.time() - start_time
+print(json.dumps({'torch': torch_time, 'total': total_time, 'tensorflow': 'tensorflow' in sys.modules}))
+"""
+
+
+def bench_import(args):
+    """
+    Imports the package in fresh interpreters and reports the time spent
+    on top of `import torch`. Exits with an error if TensorFlow gets
+    imported or the package takes longer than `--max_seconds`.
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    results = []
+    for _ in range(args.num_runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT] + args.modules, env=env)
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    torch_time = min(result['torch'] for result in results)
+    package_time = min(result['total'] - result['torch'] for result in results)
+    print('%-20s %10s' % ('', 'best (s)'))
+    print('%-20s %10.3f' % ('import torch', torch_time))
+    print('%-20s %10.3f' % ('video_prediction', package_time))
+    if any(result['tensorflow'] for result in results):
+        sys.exit('tensorflow was imported by %s' % ', '.join(args.modules))
+    if args.max_seconds and package_time > args.max_seconds:
+        sys.exit('importing video_prediction took %.3fs, more than %.3fs' % (package_time, args.max_seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--num_iters", type=int, default=20)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    cdna_parser = subparsers.add_parser('cdna', help="batched apply_cdna_kernels against the per-sample loop")
+    cdna_parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 4, 16, 32])
+    cdna_parser.add_argument("--image_size", type=int, nargs=2, default=[160, 320])
+    cdna_parser.add_argument("--num_transformed_images", type=int, default=4)
+    cdna_parser.set_defaults(fn=bench_cdna)
+
+    tile_parser = subparsers.add_parser('tile_concat', help="z conditioning: repeat, expand and folded into the conv")
+    tile_parser.add_argument("--batch_size", type=int, default=16)
+    tile_parser.add_argument("--nz", type=int, default=8)
+    tile_parser.add_argument("--sizes", type=int, nargs='+', default=[128, 64, 32, 16])
+    tile_parser.add_argument("--channels", type=int, nargs='+', default=[32, 64, 128, 256])
+    tile_parser.set_defaults(fn=bench_tile_concat)
+
+    amp_parser = subparsers.add_parser('amp', help="training step time and peak memory for each precision")
+    amp_parser.add_argument("--precisions", type=str, nargs='+', default=['fp32', 'bf16'])
+    add_savp_arguments(amp_parser)
+    amp_parser.set_defaults(fn=bench_amp)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help="training step time and peak memory for each "
+                                                                 "activation checkpointing policy")
+    checkpoint_parser.add_argument("--policies", type=str, nargs='+', default=['none', 'blocks', 'steps:1', 'steps:2'])
+    add_savp_arguments(checkpoint_parser)
+    checkpoint_parser.set_defaults(fn=bench_checkpoint)
+
+    eval_parser = subparsers.add_parser('eval', help="best-of-N evaluation time and peak memory for each number of "
+                                                     "samples and of samples drawn at once")
+    eval_parser.add_argument("--configs", type=str, nargs='+', default=['10:5', '100:5', '100:20'],
+                             help="<eval_num_samples>:<eval_parallel_iterations>")
+    add_savp_arguments(eval_parser)
+    eval_parser.set_defaults(fn=bench_eval)
+
+    unroll_parser = subparsers.add_parser('unroll', help="forward and backward of the generator unroll, outputs "
+                                                         "written into buffers against stacked")
+    unroll_parser.add_argument("--sequence_lengths", type=int, nargs='+', default=[12, 30])
+    add_savp_arguments(unroll_parser)
+    unroll_parser.set_defaults(fn=bench_unroll)
+
+    import_parser = subparsers.add_parser('import', help="import time of the package, without tensorflow")
+    import_parser.add_argument("--modules", type=str, nargs='+',
+                               default=['video_prediction.models.savp_model',
+                                        'video_prediction.datasets.base_dataset',
+                                        'video_prediction.losses',
+                                        'video_prediction.metrics'])
+    import_parser.add_argument("--num_runs", type=int, default=5)
+    import_parser.add_argument("--max_seconds", type=float, default=1.0,
+                               help="fail if the package takes longer than this to import, 0 to disable")
+    import_parser.set_defaults(fn=bench_import)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import argparse
+import glob
+import os
+
+from video_prediction.datasets.shards import pack_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pack the per-clip h5 files of a dataset split into "
+                                                 "memory-mapped shards that BaseVideoDataset reads directly")
+    parser.add_argument("--input_dir", type=str, required=True, help="directory containing the h5 files, e.g. data/comma/train")
+    parser.add_argument("--output_dir", type=str, help="directory where the shards are written. default: input_dir")
+    parser.add_argument("--clips_per_shard", type=int, default=1024, help="number of clips in each shard file")
+    parser.add_argument("--key", type=str, default='image', help="name of the h5 dataset to pack")
+    args = parser.parse_args()
+
+    # same order as BaseVideoDataset, so that the dataset indices are unchanged
+    filenames = sorted(glob.glob(os.path.join(args.input_dir, '*.h5*')))
+    num_clips = pack_shards(filenames, args.output_dir or args.input_dir,
+                            clips_per_shard=args.clips_per_shard, key=args.key)
+    print("packed %d clips from %s into %s" % (num_clips, args.input_dir, args.output_dir or args.input_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import errno
+import json
+import os
+
+import torch
+
+from video_prediction.models.savp_model import SAVPModel
+from video_prediction.serving import InferenceServer, make_http_server
+from video_prediction.utils.checkpoint import latest_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help="directory with checkpoint or checkpoint name (e.g. checkpoint_dir/model-200000.pt)")
+    parser.add_argument("--image_size", type=int, nargs=2, required=True, help="height and width of the frames")
+    parser.add_argument("--model_hparams", type=str, help="a string of comma separated list of model hyperparameters")
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, help="listen on this unix socket instead of host:port")
+    parser.add_argument("--max_batch_size", type=int, default=16, help="maximum number of requests (of different streams) in a batch")
+    parser.add_argument("--max_latency_ms", type=float, default=5.0, help="maximum time a request waits for the batch to fill up")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    ### 模型的超参数和权重来自 train.py 的输出路径
+    checkpoint_fname = args.checkpoint
+    if os.path.isdir(checkpoint_fname):
+        checkpoint_fname = latest_checkpoint(checkpoint_fname)
+    if checkpoint_fname is None or not os.path.exists(checkpoint_fname):
+        raise FileNotFoundError(errno.ENOENT, 'No checkpoint was found', args.checkpoint)
+    checkpoint_dir = os.path.dirname(checkpoint_fname)
+    with open(os.path.join(checkpoint_dir, "model_hparams.json")) as f:
+        model_hparams_dict = json.loads(f.read())
+
+    device = torch.device(args.device)
+    height, width = args.image_size
+    ### batch_size 和 sequence_length 只用于建立模型，推理时由 Rollout 决定
+    image_shape = [1, model_hparams_dict['sequence_length'], height, width, 3]
+    model = SAVPModel(image_shape, 'test', hparams_dict=model_hparams_dict, hparams=args.model_hparams, device=device)
+    print("loading model from checkpoint %s" % checkpoint_fname)
+    model.load_state_dict(torch.load(checkpoint_fname, map_location='cpu', weights_only=False)['model'])
+    model.eval()
+
+    inference_server = InferenceServer(model, max_batch_size=args.max_batch_size,
+                                       max_latency=args.max_latency_ms / 1000.0)
+    http_server = make_http_server(inference_server, args.host, args.port, args.unix_socket)
+    inference_server.start()
+    print("serving on %s" % (args.unix_socket or 'http://%s:%d' % (args.host, args.port)))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        inference_server.stop()
+
+
+if __name__ == '__main__':
+    main()
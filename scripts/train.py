@@ -1,18 +1,28 @@
 # liyi,209/6/8
 
 import argparse
+import errno
+import itertools
 import json
 import os
 import random
 import time
 import numpy as np
 import torch
+from collections import OrderedDict
 
-import video_prediction.globalvar as gl
-gl._init()
-device = gl.get_value()
-
+import video_prediction as vp
+import video_prediction.metrics
 from video_prediction.datasets.base_dataset import BaseVideoDataset
+from video_prediction.models.lpips_network import LPIPS
+from video_prediction.models.savp_model import SAVPModel
+from video_prediction.utils.checkpoint import CheckpointManager, get_rng_state, latest_checkpoint, set_rng_state
+from video_prediction.utils.prefetcher import DevicePrefetcher
+
+try:
+    from torch.utils.tensorboard import SummaryWriter
+except ImportError:
+    SummaryWriter = None
 
 def main():
     parser = argparse.ArgumentParser()
@@ -36,22 +46,42 @@ def main():
     parser.add_argument("--image_summary_freq", type=int, default=5000, help="save frequency of image summaries for train/validation set")
     parser.add_argument("--eval_summary_freq", type=int, default=25000, help="save frequency of eval summaries for train/validation set")
     parser.add_argument("--accum_eval_summary_freq", type=int, default=100000, help="save frequency of accumulated eval summaries for validation set only")
+    parser.add_argument("--lpips_weights", type=str, nargs='+', help="local files with the weights of the lpips network (backbone and linear layers). lpips is only evaluated if given")
+    parser.add_argument("--lpips_net", type=str, default='alex', choices=['alex', 'vgg'], help="backbone of the lpips network")
+    parser.add_argument("--lpips_half", action='store_true', help="run the lpips network in half precision")
     parser.add_argument("--progress_freq", type=int, default=100, help="display progress every progress_freq steps")
     parser.add_argument("--save_freq", type=int, default=5000, help="save frequence of model, 0 to disable")
+    parser.add_argument("--max_to_keep", type=int, default=5, help="number of most recent checkpoints to keep, 0 to keep all of them")
 
-    parser.add_argument("--aggregate_nccl", type=int, default=0, help="whether to use nccl or cpu for gradient aggregation in multi-gpu training")
+    parser.add_argument("--aggregate_nccl", type=int, default=1, help="whether to use nccl (1) or gloo (0) for gradient aggregation in distributed training. gloo is always used on cpu")
     parser.add_argument("--gpu_mem_frac", type=float, default=0, help="fraction of gpu memory to use")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="device to train on, e.g. cpu, cuda or cuda:1")
     parser.add_argument("--seed", type=int)
 
     args = parser.parse_args()
+    device = torch.device(args.device)
+    ### 用 torchrun 启动时为分布式训练，WORLD_SIZE, RANK 和 LOCAL_RANK 由环境变量给出 
+    ### 每个进程使用一个 device，只有 rank 0 打印进度、保存 summary 和模型 
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    if world_size > 1:
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        torch.distributed.init_process_group('nccl' if device.type == 'cuda' and args.aggregate_nccl else 'gloo')
+    is_chief = rank == 0
+    if args.gpu_mem_frac and device.type == 'cuda':
+        torch.cuda.set_per_process_memory_fraction(args.gpu_mem_frac, device)
 
     ### 设置随机数种子 5/3
+    ### 每个 rank 的种子不同，z 的采样才不会在所有 rank 上相同 
     if args.seed is not None:
-        torch.manual_seed(args.seed)    # 为CPU设置种子用于生成随机数，以使得结果是确定的 6/8
-        torch.cuda.manual_seed(args.seed) # 为当前GPU设置随机种子
-        torch.cuda.manual_seed_all()    # 使用多个GPU,为所有的GPU设置种子
-        np.random.seed(args.seed)
-        random.seed(args.seed)
+        torch.manual_seed(args.seed + rank)    # 为CPU设置种子用于生成随机数，以使得结果是确定的 6/8
+        torch.cuda.manual_seed(args.seed + rank) # 为当前GPU设置随机种子
+        torch.cuda.manual_seed_all(args.seed + rank)    # 使用多个GPU,为所有的GPU设置种子
+        np.random.seed(args.seed + rank)
+        random.seed(args.seed + rank)
         
     ### 确定输出路径 5/3
     if args.output_dir is None:
@@ -73,10 +103,12 @@ def main():
         args.output_dir = os.path.join(args.logs_dir, model_fname) + args.output_dir_postfix
         
     ### 断点训练 5/3
+    ### output_dir 中还没有 checkpoint 时从头开始训练，被抢占的任务可以一直带着 --resume 重新启动 
     if args.resume:
         if args.checkpoint:
             raise ValueError('resume and checkpoint cannot both be specified')
-        args.checkpoint = args.output_dir
+        if latest_checkpoint(args.output_dir):
+            args.checkpoint = args.output_dir
         
     ### 加载数据集和模型的超参数 5/3
     dataset_hparams_dict = {}
@@ -111,17 +143,37 @@ def main():
         except FileNotFoundError:
             print("model_hparams.json was not loaded because it does not exist")
 
-    print('----------------------------------- Options ------------------------------------')
-    for k, v in args._get_kwargs():
-        print(k, "=", v)
-    print('------------------------------------- End --------------------------------------')
+    if is_chief:
+        print('----------------------------------- Options ------------------------------------')
+        for k, v in args._get_kwargs():
+            print(k, "=", v)
+        print('------------------------------------- End --------------------------------------')
 
     ### 生成数据集 6/8
-    train_dataset = BaseVideoDataset(input_dir = './data/comma', mode='train', hparams_dict=dataset_hparams_dict)
+    train_dataset = BaseVideoDataset(input_dir=args.input_dir, mode='train', hparams_dict=dataset_hparams_dict,
+                                     hparams=args.dataset_hparams)
+    ### 分布式训练时每个 rank 读取不同的 sample，sampler 的种子在所有 rank 上相同 
+    train_sampler = train_dataset.make_sampler(world_size, rank, seed=args.seed or 0)
     train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size,
-                                          shuffle=True, num_workers=2)
-    dataiter = iter(train_loader)
-    val_dataset = None   ### 待完成 6/8
+                                          sampler=train_sampler, num_workers=2, persistent_workers=True,
+                                          pin_memory=device.type == 'cuda', drop_last=True,
+                                          worker_init_fn=BaseVideoDataset.worker_init_fn)
+    ### 验证集，默认在 input_dir/val 中 
+    val_input_dir = args.val_input_dir or args.input_dir
+    try:
+        val_dataset = BaseVideoDataset(input_dir=val_input_dir, mode='val', hparams_dict=dataset_hparams_dict,
+                                       hparams=args.dataset_hparams)
+    except FileNotFoundError:
+        val_dataset = None
+        if is_chief:
+            print("no validation set was found in %s, eval summaries are not saved" % val_input_dir)
+    
+    def make_val_loader():
+        ### 每个 rank 评估验证集中不同的 sample (样本数不能整除时 sampler 会补齐，所有 rank 的 batch 数相同)
+        return torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size,
+                                           sampler=val_dataset.make_sampler(world_size, rank, seed=args.seed or 0),
+                                           num_workers=2, pin_memory=device.type == 'cuda',
+                                           worker_init_fn=BaseVideoDataset.worker_init_fn)
     
     ### 确定模型 6/8
     hparams_dict = dict(model_hparams_dict)
@@ -130,14 +182,196 @@ def main():
         'sequence_length': train_dataset.hparams.sequence_length,
         'repeat': train_dataset.hparams.time_shift,
     })
-    image_shape = None
-    model = SAVPModel(image_shape, 'train', hparams_dict=hparams_dict)
-    model.to(device)
+    ### NDHWC，帧的大小从第一个 sample 得到 
+    image_shape = [args.batch_size] + list(train_dataset[0]['images'].shape)
+    model = SAVPModel(image_shape, 'train', hparams_dict=hparams_dict, hparams=args.model_hparams, device=device)
+    model.train()
+    if args.seed is not None:
+        ### discriminator 的随机采样也由 seed 决定，每个 rank 不同 
+        model.seed(args.seed + rank)
+    if world_size > 1:
+        ### 建立 DDP 时参数和 buffer 从 rank 0 广播到所有 rank 
+        model.distribute(device_ids=[device.index] if device.type == 'cuda' else None)
+    g_optimizer, d_optimizer = model.make_optimizers()
+    lpips_network = None
+    if val_dataset is not None and args.lpips_weights:
+        lpips_network = LPIPS(args.lpips_net, args.lpips_weights, half=args.lpips_half).to(device)
+    scaler = model.grad_scaler()
+    
+    summary_writer = None
+    checkpoint_manager = None
+    if is_chief:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        with open(os.path.join(args.output_dir, "options.json"), "w") as f:
+            f.write(json.dumps(vars(args), sort_keys=True, indent=4))
+        with open(os.path.join(args.output_dir, "dataset_hparams.json"), "w") as f:
+            f.write(train_dataset.hparams.to_json(indent=4, sort_keys=True))
+        with open(os.path.join(args.output_dir, "model_hparams.json"), "w") as f:
+            f.write(model.hparams.to_json(indent=4, sort_keys=True))
+        ### 在后台线程中写 checkpoint，训练不用等待 
+        checkpoint_manager = CheckpointManager(args.output_dir, max_to_keep=args.max_to_keep)
+        if SummaryWriter is not None:
+            summary_writer = SummaryWriter(args.output_dir)
+        else:
+            print("tensorboard is not installed, summaries are not saved")
+    
+    def should(step, freq):
+        return freq and ((step + 1) % freq == 0 or step + 1 == args.max_steps)
+    
+    ### 后台线程预取 batch 并提前拷贝到 device 上 
+    ### DataLoader 的 worker 是在预取线程里 fork 出来的，此时主线程不能在读 h5 (HDF5 的锁会被带进子进程)，
+    ### 所以放在读取 train_dataset[0] 和建立模型之后 
+    dataiter = DevicePrefetcher(train_loader, device, num_epochs=train_dataset.num_epochs)
+    
+    start_step = 0
+    if args.checkpoint:
+        checkpoint_fname = args.checkpoint
+        if os.path.isdir(checkpoint_fname):
+            checkpoint_fname = latest_checkpoint(checkpoint_fname)
+        elif not os.path.exists(checkpoint_fname) and os.path.exists(checkpoint_fname + '.pt'):
+            checkpoint_fname += '.pt'
+        if checkpoint_fname is None or not os.path.exists(checkpoint_fname):
+            raise FileNotFoundError(errno.ENOENT, 'No checkpoint was found', args.checkpoint)
+        if is_chief:
+            print("restoring from checkpoint %s" % checkpoint_fname)
+        checkpoint = torch.load(checkpoint_fname, map_location='cpu', weights_only=False)
+        model.load_state_dict(checkpoint['model'])
+        g_optimizer.load_state_dict(checkpoint['g_optimizer'])
+        d_optimizer.load_state_dict(checkpoint['d_optimizer'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        start_step = checkpoint['step']
+        ### 从 checkpoint 时的数据位置继续，不重复也不跳过 sample 
+        dataiter.load_state_dict(checkpoint['data'])
+        if len(checkpoint['rng']) == world_size:
+            set_rng_state(checkpoint['rng'][rank])
+            if 'discrim' in checkpoint['rng'][rank] and model.discrim_generator is not None:
+                model.discrim_generator.set_state(checkpoint['rng'][rank]['discrim'])
+        del checkpoint
+    ### worker 的种子由 train_loader.generator 决定，不在预取线程里消耗全局的 RNG 
+    ### 种子由 seed、rank 和开始的 step 得到，从同一个 checkpoint 恢复时 worker 的种子相同 
+    loader_generator = torch.Generator()
+    if args.seed is not None:
+        loader_generator.manual_seed((args.seed + rank) * 2 ** 32 + start_step)
+    else:
+        loader_generator.seed()
+    train_loader.generator = loader_generator
+    dataiter = iter(dataiter)
     
-    for step in range(0, args.max_steps):
-        samples = dataiter.next()
+    def evaluate(batches):
+        ### 只跑 generator，metric 在 device 上逐 batch 累加，不保存预测结果 
+        ### 所有 rank 都要调用 (最后对累加结果做 all_reduce) 
+        model.eval()
+        accumulator = vp.metrics.MetricAccumulator()
+        with torch.no_grad():
+            for val_samples in batches:
+                val_outputs = model.generate(val_samples)
+                accumulator.update(model.frame_metrics_fn(val_samples, val_outputs, lpips_network=lpips_network))
+        model.train()
+        accumulator.all_reduce()
+        return accumulator.result()
+    
+    def write_eval_summaries(prefix, frame_metrics, step):
+        for metric_name, metric in frame_metrics.items():
+            metric = metric.cpu()
+            if is_chief:
+                print("   %s_%s %g" % (prefix, metric_name, metric.mean()))
+            if summary_writer is not None:
+                summary_writer.add_scalar('%s_%s' % (prefix, metric_name), metric.mean(), step)
+                for t, value in enumerate(metric):
+                    summary_writer.add_scalar('%s_%s/frame_%d' % (prefix, metric_name, t), value, step)
+    
+    val_batches = None
+    start_time = time.time()
+    data_wait_time = 0.0
+    ### 上次打印进度时的 step，从非 progress_freq 整数倍的 step 恢复时也能得到正确的步数 
+    last_progress_step = start_step
+    for step in range(start_step, args.max_steps):
+        samples = next(dataiter)
+        data_wait_time += dataiter.wait_time
         
+        outputs, d_losses, g_losses = model.train_step(samples, g_optimizer, d_optimizer, scaler, step)
         
+        ### 只在需要打印或保存 summary 时把 loss 取回 host，避免每一步都同步 
+        if is_chief and (should(step, args.summary_freq) or should(step, args.progress_freq)):
+            losses = OrderedDict((k, loss.item()) for k, (loss, _) in itertools.chain(d_losses.items(), g_losses.items()))
+            d_loss = sum(losses[k] * weight for k, (_, weight) in d_losses.items())
+            g_loss = sum(losses[k] * weight for k, (_, weight) in g_losses.items())
+        
+        if summary_writer is not None and should(step, args.summary_freq):
+            for k, v in losses.items():
+                summary_writer.add_scalar(k, v, step + 1)
+            summary_writer.add_scalar('d_loss', d_loss, step + 1)
+            summary_writer.add_scalar('g_loss', g_loss, step + 1)
+            summary_writer.add_scalar('learning_rate', model.learning_rate(step), step + 1)
+            if model.kl_weight is not None:
+                summary_writer.add_scalar('kl_weight', model.kl_weight, step + 1)
+        if summary_writer is not None and should(step, args.image_summary_freq):
+            ### 第一个样本的所有帧，(D, C, H, W) 
+            summary_writer.add_images('images', samples['images'][:, 0], step + 1)
+            summary_writer.add_images('gen_images', outputs['gen_images'][:, 0].float().clamp(0, 1), step + 1)
+        
+        if is_chief and should(step, args.progress_freq):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            num_steps = step + 1 - last_progress_step
+            elapsed_time = time.time() - start_time
+            ### samples/sec 是所有 rank 的总和，loss 和 data wait 只是 rank 0 的 
+            progress = "step %d, lr %g, %.2f steps/sec, %.1f samples/sec, data wait %.4fs/step" % \
+                       (step + 1, model.learning_rate(step), num_steps / elapsed_time,
+                        num_steps * args.batch_size * world_size / elapsed_time, data_wait_time / num_steps)
+            ### h5 文件池的统计是所有 worker 的总和 (共享内存中的计数) 
+            h5_pool_stats = train_dataset.h5_pool_stats()
+            if h5_pool_stats is not None:
+                progress += ", h5 pool hit rate %.3f, %d open files" % (h5_pool_stats['hit_rate'], h5_pool_stats['open'])
+            print(progress)
+            print("   d_loss %g, g_loss %g" % (d_loss, g_loss))
+            for k, v in losses.items():
+                print("   %s %g" % (k, v))
+            start_time = time.time()
+            data_wait_time = 0.0
+            last_progress_step = step + 1
+        
+        if val_dataset is not None and should(step, args.eval_summary_freq):
+            ### 每次在验证集的下一个 batch 上评估 
+            if val_batches is None:
+                val_batches = iter(DevicePrefetcher(make_val_loader(), device, num_epochs=None))
+            if is_chief:
+                print("evaluating a validation batch at step %d" % (step + 1))
+            write_eval_summaries('eval', evaluate([next(val_batches)]), step + 1)
+        if val_dataset is not None and should(step, args.accum_eval_summary_freq):
+            ### 在整个验证集上评估 
+            if is_chief:
+                print("evaluating the validation set at step %d" % (step + 1))
+            write_eval_summaries('accum_eval', evaluate(DevicePrefetcher(make_val_loader(), device)), step + 1)
+        
+        if should(step, args.save_freq):
+            ### 每个 rank 的 RNG 状态不同，都要保存；all_gather_object 需要所有 rank 参与 
+            rng_state = get_rng_state()
+            if model.discrim_generator is not None:
+                rng_state['discrim'] = model.discrim_generator.get_state()
+            rng_states = [rng_state]
+            if world_size > 1:
+                rng_states = [None] * world_size
+                torch.distributed.all_gather_object(rng_states, rng_state)
+            if is_chief:
+                checkpoint_fname = checkpoint_manager.save(step + 1, {
+                    'step': step + 1,
+                    'model': model.state_dict(),
+                    'g_optimizer': g_optimizer.state_dict(),
+                    'd_optimizer': d_optimizer.state_dict(),
+                    'scaler': scaler.state_dict(),
+                    'rng': rng_states,
+                    'data': dataiter.state_dict()})
+                print("saving model to %s" % checkpoint_fname)
     
-    
-    
\ No newline at end of file
+    if summary_writer is not None:
+        summary_writer.close()
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # 日期：2019/5/6
 
 import glob
+import itertools
 import os
 import random
 import re
@@ -11,10 +12,37 @@ from collections import OrderedDict
 import numpy as np
 import torch
 import torch.utils.data as data
-from tensorflow.contrib.training import HParams
 
-import video_prediction.globalvar as gl
-device = gl.get_value()
+from video_prediction.datasets.h5_pool import H5FilePool
+from video_prediction.datasets.shards import ShardReader, has_shards
+from video_prediction.utils.hparams import HParams
+
+class EpochSampler(data.DistributedSampler):
+    """
+    A `DistributedSampler`, also used with a single replica, whose order only
+    depends on the seed and the epoch. An epoch can be started in the middle,
+    so that training resumes at the exact data position of a checkpoint.
+    """
+    def __init__(self, *args, **kwargs):
+        super(EpochSampler, self).__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        """
+        Args:
+            epoch: the epoch, which determines the shuffling.
+            start_index: the number of samples of this epoch already
+                consumed by this rank, which are skipped.
+        """
+        super(EpochSampler, self).set_epoch(epoch)
+        self.start_index = start_index
+
+    def __iter__(self):
+        return itertools.islice(super(EpochSampler, self).__iter__(), self.start_index, None)
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
 
 class BaseVideoDataset(data.Dataset):
     def __init__(self, input_dir, mode='train', num_epochs=None, seed=None,
@@ -34,7 +62,9 @@ class BaseVideoDataset(data.Dataset):
                 These values overrides any values in hparams_dict (if any).
 
         Note:
-            self.input_dir is the directory containing the h5.
+            self.input_dir is the directory containing the h5, or the shards
+            written by `video_prediction.datasets.shards.pack_shards`. The
+            shards are preferred when both are present.
         """
         self.input_dir = os.path.normpath(os.path.expanduser(input_dir))
         self.mode = mode
@@ -47,16 +77,21 @@ class BaseVideoDataset(data.Dataset):
         if not os.path.exists(self.input_dir):
             raise FileNotFoundError("input_dir %s does not exist" % self.input_dir)
         self.filenames = None
+        self.shard_reader = None
         # look for tfrecords in input_dir and input_dir/mode directories
         for input_dir in [self.input_dir, os.path.join(self.input_dir, self.mode)]:  ### 照应前面注释 5/3
+            if has_shards(input_dir):
+                self.input_dir = input_dir
+                self.shard_reader = ShardReader(input_dir)
+                break
             ### glob.glob()匹配所有的符合条件的文件，并将其以list的形式返回 5/3
             filenames = glob.glob(os.path.join(input_dir, '*.h5*'))  ### tfrecords改为h5 5/4
             if filenames:
                 self.input_dir = input_dir
                 self.filenames = sorted(filenames)  # ensures order is the same across systems
                 break
-        if not self.filenames:
-            raise FileNotFoundError('No h5 were found in %s.' % self.input_dir)  ### tfrecords改为h5 5/4
+        if not self.filenames and self.shard_reader is None:
+            raise FileNotFoundError('No h5 or shards were found in %s.' % self.input_dir)  ### tfrecords改为h5 5/4
         ### os.path.split(),以 "PATH" 中最后一个 '/' 作为分隔符，将“文件名”和“路径”分割开，并不智能 5/3
         ### os.path.basename()，返回文件名 5/3
         ### 这里就是根据数据集的路径来确定数据集的名称dataset_name 5/3
@@ -66,12 +101,31 @@ class BaseVideoDataset(data.Dataset):
         self.action_like_names_and_shapes = OrderedDict()
 
         self.hparams = self.parse_hparams(hparams_dict,hparams)
+        ### 每个 worker 各自缓存打开的 h5 文件，避免每个 sample 都重新打开
+        self.h5_pool = H5FilePool(self.hparams.h5_pool_size) if self.hparams.h5_pool_size else None
         
     def __getitem__(self,index):
         ### 每个 h5 文件中是一个数据 5/19
         ### 含有 'images','speed','angle'
         ### 其中 images.sahpe = (30,160,320,3) 
-        f = h5py.File(self.filenames[index], 'r')
+        ### sample_id 用于在多次 validation 之间缓存 ground truth 的特征 (见 video_prediction.metrics.lpips)
+        if self.shard_reader is not None:
+            state_like_t_slice, _ = self.sample_time_slices(self.shard_reader.clip_shape[0])
+            sample = {'images': torch.from_numpy(self.shard_reader.read(index, state_like_t_slice)),
+                      'sample_id': self.sample_id(index, state_like_t_slice)}
+        elif self.h5_pool is None:
+            with h5py.File(self.filenames[index], 'r') as f:
+                sample = self.read_sample(f, index)
+        else:
+            sample = self.read_sample(self.h5_pool.get(self.filenames[index]), index)
+        return sample
+
+    def sample_id(self, index, state_like_t_slice):
+        ### force_time_shift 时同一个 sample 每次的 t_start 不同，ground truth 的帧也不同，
+        ### 所以 sample_id 同时由 index 和 t_start 决定 (index < len(self))
+        return index + len(self) * state_like_t_slice.start
+
+    def read_sample(self, f, index):
         '''sample = dict(f)
         #sample['images'] = sample.pop('image')
         for k in sample.keys():   ### 将h5文件中的dataset数据类型转化为np类型
@@ -80,14 +134,49 @@ class BaseVideoDataset(data.Dataset):
             #    sample.pop(k)'''
         sample = {}
         #sample['images'] = torch.tensor(f['image'].value.astype(np.float32)).cuda(device)
-        sample['images'] = f['image'].value.astype(np.float32)
-        sample['images'] = torch.tensor(sample['images'])
-        f.close()
+        ### 先确定 t_start，再用 h5 的 hyperslab 只读取需要的帧
+        images = f['image']
+        state_like_t_slice, _ = self.sample_time_slices(images.shape[0])
+        ### 保持 uint8，from_numpy 不复制数据；转为 float 放到 device 上完成
+        ### (见 video_prediction.utils.util.preprocess_images)
+        sample['images'] = torch.from_numpy(images[state_like_t_slice])
+        sample['sample_id'] = self.sample_id(index, state_like_t_slice)
         return sample
     
     def __len__(self):
+        if self.shard_reader is not None:
+            return len(self.shard_reader)
         return len(self.filenames)
 
+    def reset_h5_pool(self):
+        if self.h5_pool is not None:
+            self.h5_pool.reset()
+
+    def h5_pool_stats(self):
+        return self.h5_pool.stats() if self.h5_pool is not None else None
+
+    def make_sampler(self, num_replicas=1, rank=0, seed=0):
+        """
+        Returns the `EpochSampler` of the DataLoader of this dataset. The
+        samples are shuffled if mode is 'train', or 'val' with
+        shuffle_on_val.
+
+        With num_replicas > 1, each rank iterates over its own disjoint
+        share of the samples. `set_epoch` has to be called before every
+        epoch to reshuffle (`DevicePrefetcher` does it). `seed` must be the
+        same on all the ranks.
+        """
+        shuffle = self.mode == 'train' or (self.mode == 'val' and self.hparams.shuffle_on_val)
+        return EpochSampler(self, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed,
+                            drop_last=num_replicas > 1 and self.mode == 'train')
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        ### 作为 DataLoader 的 worker_init_fn，在每个 worker 中重建 h5 文件池
+        worker_info = data.get_worker_info()
+        if isinstance(worker_info.dataset, BaseVideoDataset):
+            worker_info.dataset.reset_h5_pool()
+
     def get_default_hparams_dict(self):
         """
         Returns:
@@ -113,6 +202,8 @@ class BaseVideoDataset(data.Dataset):
             shuffle_on_val: whether to shuffle the samples regardless if mode
                 is 'train' or 'val'. Shuffle never happens when mode is 'test'.
             use_state: whether to load and return state and actions.
+            h5_pool_size: the number of h5 files kept open by each DataLoader
+                worker. 0 opens and closes the file for every sample.
         """
         hparams = dict(
             crop_size=0,
@@ -125,6 +216,7 @@ class BaseVideoDataset(data.Dataset):
             force_time_shift=False,
             shuffle_on_val=False,
             use_state=False,
+            h5_pool_size=32,
         )
         return hparams
 
@@ -240,41 +332,52 @@ class BaseVideoDataset(data.Dataset):
         return images
     '''
 
-    def slice_sequences(self, state_like_seqs, action_like_seqs, example_sequence_length):
-        ### 其他地方没用到？ 5/19
+    def sample_time_slices(self, example_sequence_length):
         """
-        Slices sequences of length `example_sequence_length` into subsequences
-        of length `sequence_length`. The dicts of sequences are updated
-        in-place and the same dicts are returned.
+        Samples the start of a subsequence of length `sequence_length` from a
+        sequence of length `example_sequence_length`.
+
+        Returns:
+            A tuple of the `slice` for state-like sequences and the `slice`
+            for action-like sequences. They can be applied to the sequences
+            in memory or passed to h5py to read only the selected frames.
         """
         # handle random shifting and frame skip
         sequence_length = self.hparams.sequence_length  # desired sequence length
         frame_skip = self.hparams.frame_skip   ### 使用的两帧之间相隔几帧 5/4
         time_shift = self.hparams.time_shift   ### 
+        example_sequence_length = int(example_sequence_length)
+        num_shifts = ((example_sequence_length - 1) - (sequence_length - 1) * (frame_skip + 1))
+        if num_shifts < 0:
+            raise ValueError('example_sequence_length has to be at least %d when '
+                             'sequence_length=%d, frame_skip=%d, but %d given.' %
+                             ((sequence_length - 1) * (frame_skip + 1) + 1,
+                              sequence_length, frame_skip, example_sequence_length))
         if (time_shift and self.mode == 'train') or self.hparams.force_time_shift:
             assert time_shift > 0 and isinstance(time_shift, int)
-            #if isinstance(example_sequence_length, tf.Tensor):
-            #    example_sequence_length = tf.cast(example_sequence_length, tf.int32)
-            example_sequence_length = np.array(example_sequence_length).astype(np.int32)
-            num_shifts = ((example_sequence_length - 1) - (sequence_length - 1) * (frame_skip + 1)) // time_shift
-            assert_message = ('example_sequence_length has to be at least %d when '
-                              'sequence_length=%d, frame_skip=%d.' %
-                              ((sequence_length - 1) * (frame_skip + 1) + 1,
-                               sequence_length, frame_skip))
-            '''with tf.control_dependencies([tf.assert_greater_equal(num_shifts, 0,
-                    data=[example_sequence_length, num_shifts], message=assert_message)]):
-                t_start = tf.random_uniform([], 0, num_shifts + 1, dtype=tf.int32, seed=self.seed) * time_shift'''
+            num_shifts //= time_shift
             ### 生成一个0~num_shifts+1的随机数,不包括num_shifts+1 5/4
-            t_start = np.random.randint(0, num_shifts + 1, dtype=np.int32) * time_shift
+            t_start = np.random.randint(0, num_shifts + 1) * time_shift
         else:
             t_start = 0
         state_like_t_slice = slice(t_start, t_start + (sequence_length - 1) * (frame_skip + 1) + 1, frame_skip + 1)
         action_like_t_slice = slice(t_start, t_start + (sequence_length - 1) * (frame_skip + 1))
+        return state_like_t_slice, action_like_t_slice
+
+    def slice_sequences(self, state_like_seqs, action_like_seqs, example_sequence_length):
+        """
+        Slices sequences of length `example_sequence_length` into subsequences
+        of length `sequence_length`. The dicts of sequences are updated
+        in-place and the same dicts are returned.
+        """
+        sequence_length = self.hparams.sequence_length
+        frame_skip = self.hparams.frame_skip
+        state_like_t_slice, action_like_t_slice = self.sample_time_slices(example_sequence_length)
 
         ### 按照切片取出需要的帧 5/4
         for example_name, seq in state_like_seqs.items():
             seq = seq[state_like_t_slice]
-            seq = np.reshape(seq, [sequence_length] + seq.shape.as_list()[1:])
+            seq = np.reshape(seq, [sequence_length] + list(seq.shape)[1:])
             state_like_seqs[example_name] = seq
         for example_name, seq in action_like_seqs.items():
             seq = seq[action_like_t_slice]
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import h5py
+
+
+class H5FilePool(object):
+    """
+    LRU pool of read-only h5 file handles.
+
+    Each DataLoader worker keeps its own handles: the pool remembers the pid
+    of the process that opened them and drops everything it inherited through
+    a fork, and `__getstate__` never pickles open handles. The hit/miss/
+    eviction counters live in shared memory so that the statistics of all the
+    workers are visible from the main process, as is the number of handles
+    open in all the processes.
+    """
+    HITS, MISSES, EVICTIONS, OPEN = range(4)
+
+    def __init__(self, max_size=32):
+        if max_size < 1:
+            raise ValueError('max_size must be positive, but %r given' % max_size)
+        self.max_size = max_size
+        self._counters = multiprocessing.Array('q', 4)
+        self._files = OrderedDict()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+
+    def _count(self, counter, value=1):
+        with self._counters.get_lock():
+            self._counters[counter] += value
+
+    def get(self, filename):
+        """
+        Returns an open handle of `filename`. The handle is owned by the pool
+        and must not be closed by the caller.
+        """
+        if self._pid != os.getpid():
+            # handles inherited through fork belong to the parent process
+            self.reset(close=False)
+        f = self._files.get(filename)
+        if f is not None:
+            self._files.move_to_end(filename)
+            self._count(self.HITS)
+            return f
+        self._count(self.MISSES)
+        f = h5py.File(filename, 'r')
+        self._files[filename] = f
+        self._count(self.OPEN)
+        while len(self._files) > self.max_size:
+            _, evicted = self._files.popitem(last=False)
+            evicted.close()
+            self._count(self.EVICTIONS)
+            self._count(self.OPEN, -1)
+        return f
+
+    def reset(self, close=True):
+        if close:
+            for f in self._files.values():
+                f.close()
+            self._count(self.OPEN, -len(self._files))
+        self._files = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._files)
+
+    @property
+    def hit_rate(self):
+        hits, misses = self._counters[self.HITS], self._counters[self.MISSES]
+        return hits / float(hits + misses) if hits + misses else 0.0
+
+    def stats(self):
+        return OrderedDict([
+            ('max_size', self.max_size),
+            ('hits', self._counters[self.HITS]),
+            ('misses', self._counters[self.MISSES]),
+            ('evictions', self._counters[self.EVICTIONS]),
+            ('open', self._counters[self.OPEN]),
+            ('hit_rate', self.hit_rate),
+        ])
@@ -0,0 +1,122 @@
+import json
+import os
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+SHARD_INDEX_FILENAME = 'shards.json'
+SHARD_OFFSETS_FILENAME = 'shard_offsets.npy'
+
+
+def pack_shards(filenames, output_dir, clips_per_shard=1024, key='image'):
+    """
+    Packs the `key` dataset of many small h5 files into a few large shards.
+
+    Every clip is stored as raw bytes with the same stride, so the shards can
+    be memory-mapped and any clip is found in O(1) from the offset index.
+    The index is written last, so a partially converted directory is never
+    picked up by `ShardReader`.
+
+    Args:
+        filenames: the h5 files, in the order of the dataset indices.
+        output_dir: directory where the shards and the index are written.
+        clips_per_shard: the number of clips in each shard file.
+        key: name of the dataset in the h5 files.
+
+    Returns:
+        The number of packed clips.
+    """
+    if not filenames:
+        raise ValueError('No h5 files to pack.')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with h5py.File(filenames[0], 'r') as f:
+        clip_shape = tuple(f[key].shape)
+        dtype = f[key].dtype
+    clip_nbytes = int(np.prod(clip_shape)) * dtype.itemsize
+
+    shards = []
+    offsets = np.zeros([len(filenames), 2], dtype=np.int64)
+    shard_file = None
+    for i, filename in enumerate(filenames):
+        if i % clips_per_shard == 0:
+            if shard_file is not None:
+                shard_file.close()
+            shards.append(OrderedDict([('filename', 'shard-%05d.bin' % len(shards)), ('num_clips', 0)]))
+            shard_file = open(os.path.join(output_dir, shards[-1]['filename']), 'wb')
+        with h5py.File(filename, 'r') as f:
+            clip = f[key][()]
+        if clip.shape != clip_shape or clip.dtype != dtype:
+            raise ValueError('All clips must have shape %r and dtype %s, but %s has shape %r and dtype %s' %
+                             (clip_shape, dtype, filename, clip.shape, clip.dtype))
+        offsets[i] = len(shards) - 1, shards[-1]['num_clips'] * clip_nbytes
+        shard_file.write(np.ascontiguousarray(clip).tobytes())
+        shards[-1]['num_clips'] += 1
+    shard_file.close()
+
+    np.save(os.path.join(output_dir, SHARD_OFFSETS_FILENAME), offsets)
+    index = OrderedDict([
+        ('key', key),
+        ('clip_shape', list(clip_shape)),
+        ('dtype', dtype.str),
+        ('clip_nbytes', clip_nbytes),
+        ('num_clips', len(filenames)),
+        ('shards', shards),
+        ('sources', [os.path.basename(filename) for filename in filenames]),
+    ])
+    index_fname = os.path.join(output_dir, SHARD_INDEX_FILENAME)
+    with open(index_fname + '.tmp', 'w') as f:
+        json.dump(index, f, indent=4)
+    os.replace(index_fname + '.tmp', index_fname)
+    return len(filenames)
+
+
+def has_shards(input_dir):
+    return os.path.exists(os.path.join(input_dir, SHARD_INDEX_FILENAME))
+
+
+class ShardReader(object):
+    """
+    Random access to the clips written by `pack_shards` through `np.memmap`.
+
+    The shards are mapped lazily by the process that reads them and the maps
+    are never pickled, so the reader can be shared with DataLoader workers.
+    """
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        with open(os.path.join(input_dir, SHARD_INDEX_FILENAME)) as f:
+            self.index = json.load(f)
+        self.offsets = np.load(os.path.join(input_dir, SHARD_OFFSETS_FILENAME))
+        self.clip_shape = tuple(self.index['clip_shape'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.clip_nbytes = self.index['clip_nbytes']
+        assert len(self.offsets) == self.index['num_clips']
+        self._maps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _get_map(self, shard_id):
+        mm = self._maps.get(shard_id)
+        if mm is None:
+            shard = self.index['shards'][shard_id]
+            mm = np.memmap(os.path.join(self.input_dir, shard['filename']), dtype=np.uint8, mode='r',
+                           shape=(shard['num_clips'] * self.clip_nbytes,))
+            self._maps[shard_id] = mm
+        return mm
+
+    def read(self, index, t_slice=slice(None)):
+        """
+        Returns a copy of the frames `t_slice` of the clip `index`. Only the
+        pages of the selected frames are touched.
+        """
+        shard_id, offset = self.offsets[index]
+        mm = self._get_map(int(shard_id))
+        clip = mm[offset:offset + self.clip_nbytes].view(self.dtype).reshape(self.clip_shape)
+        return np.array(clip[t_slice])
@@ -4,11 +4,9 @@ copied from https://github.com/ndrplz/ConvLSTM_pytorch
 """
 
 import torch.nn as nn
-from torch.autograd import Variable
 import torch
 
-import video_prediction.globalvar as gl
-device = gl.get_value()   ### 获取全局device 6/8
+from video_prediction.utils.util import conv2d_tile_concat
 
 class ConvLSTMCell(nn.Module):
 
@@ -46,13 +44,17 @@ class ConvLSTMCell(nn.Module):
                               padding=self.padding,
                               bias=self.bias)
 
-    def forward(self, input_tensor, cur_state):
+    def forward(self, input_tensor, cur_state, z=None):
         ### input_tensor 应当是 NCHW 5/26
+        ### z=(N,nz) 不为 None 时，相当于 input_tensor 之后拼接了空间上复制的 z，z 直接折叠进卷积
         h_cur, c_cur = cur_state
         
         combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
         
-        combined_conv = self.conv(combined)
+        if z is None:
+            combined_conv = self.conv(combined)
+        else:
+            combined_conv = conv2d_tile_concat(self.conv, combined, z, z_start=input_tensor.shape[1])
         cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1) 
         i = torch.sigmoid(cc_i)
         f = torch.sigmoid(cc_f)
@@ -65,8 +67,9 @@ class ConvLSTMCell(nn.Module):
         return h_next, c_next
 
     def init_hidden(self, batch_size):
-        return (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).cuda(device),
-                Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).cuda(device))
+        weight = self.conv.weight
+        return (torch.zeros(batch_size, self.hidden_dim, self.height, self.width, device=weight.device, dtype=weight.dtype),
+                torch.zeros(batch_size, self.hidden_dim, self.height, self.width, device=weight.device, dtype=weight.dtype))
 
 
 class ConvLSTM(nn.Module):
@@ -2,8 +2,6 @@
 
 import torch
 
-import video_prediction.globalvar as gl
-device = gl.get_value()
 
 def l1_loss(pred, target):
     criterion = torch.nn.L1Loss()
@@ -30,13 +28,15 @@ def charbonnier_loss(x, epsilon=0.001):
 
 def gan_loss(logits, labels, gan_loss_type):
     # use 1.0 (or 1.0 - discrim_label_smooth) for real data and 0.0 for fake data
+    # always computed in fp32, also under autocast
+    logits = logits.float()
     if gan_loss_type == 'GAN':
         # discrim_loss = tf.reduce_mean(-(tf.log(predict_real + EPS) + tf.log(1 - predict_fake + EPS)))
         # gen_loss = tf.reduce_mean(-tf.log(predict_fake + EPS))
         if labels in (0.0, 1.0):
             # labels = tf.constant(labels, dtype=logits.dtype, shape=logits.get_shape())
             # loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=logits, labels=labels))
-            labels = (labels * torch.ones(logits.shape).cuda(device)).type_as(logits)
+            labels = torch.full_like(logits, labels)
             criterion = torch.nn.BCEWithLogitsLoss()
             loss = torch.mean(criterion(logits, labels))
         else:
@@ -61,6 +61,10 @@ def gan_loss(logits, labels, gan_loss_type):
 
 
 def kl_loss(mu, log_sigma_sq, mu2=None, log_sigma2_sq=None):
+    # always computed in fp32, also under autocast
+    mu, log_sigma_sq = mu.float(), log_sigma_sq.float()
+    if mu2 is not None:
+        mu2, log_sigma2_sq = mu2.float(), log_sigma2_sq.float()
     if mu2 is None and log_sigma2_sq is None:
         sigma_sq = torch.exp(log_sigma_sq)
         return -0.5 * torch.mean(torch.sum(1 + log_sigma_sq - torch.pow(mu, 2) - sigma_sq, dim=-1))
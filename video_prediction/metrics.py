@@ -1,29 +1,180 @@
 ### liyi, 2019/6/8
-### 待完成。。。
+### 所有的 metric 都是 torch 实现，在 tensor 所在的 device 上计算，输入为 (..., C, H, W)，输出为 (...)
+
+from collections import OrderedDict
 
 import torch
+import torch.nn.functional as F
 import numpy as np
-#import lpips_tf
 
 
 def mse(a, b):
     return torch.mean(torch.pow(a-b, 2), (-3, -2, -1))
 
-def psnr(a, b):
-    rmse = torch.sqrt(torch.mean(torch.pow(a-b, 2), (-3, -2, -1)))
-    psnr = 20 * torch.log(255.0 / rmse)   ### 255 还是 1.。。 6/8
-    return psnr
+
+def psnr_from_mse(mse, data_range=1.0):
+    return 10 * torch.log10(data_range ** 2 / mse)
+
+
+def psnr(a, b, data_range=1.0):
+    """
+    Peak signal-to-noise ratio of each image, where `data_range` is the
+    difference between the largest and the smallest possible values, i.e.
+    1 for float images in [0, 1] (the outputs of the model) and 255 for
+    uint8 images.
+    """
+    return psnr_from_mse(mse(a, b), data_range)
+
+
+def gaussian_kernel(size, sigma, device=None, dtype=torch.float32):
+    coords = torch.arange(size, device=device, dtype=dtype) - (size - 1) / 2.0
+    kernel = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
 
 
-def ssim(a, b):
-    return tf.image.ssim(a, b, 1.0)
+def gaussian_filter(x, kernel):
+    ### 可分离的高斯滤波，先沿 H 再沿 W，每个 channel 独立 (depthwise)
+    ### 不做 padding，与 tf.image.ssim 相同
+    channels = x.shape[1]
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1).expand(channels, 1, -1, 1), groups=channels)
+    return F.conv2d(x, kernel.view(1, 1, 1, -1).expand(channels, 1, 1, -1), groups=channels)
 
 
-def lpips(input0, input1):
-    if input0.shape[-1].value == 1:
-        input0 = tf.tile(input0, [1] * (input0.shape.ndims - 1) + [3])
-    if input1.shape[-1].value == 1:
-        input1 = tf.tile(input1, [1] * (input1.shape.ndims - 1) + [3])
+def ssim(a, b, data_range=1.0, filter_size=11, filter_sigma=1.5, k1=0.01, k2=0.03):
+    """
+    Structural similarity of each image, with the same Gaussian window and
+    constants as `tf.image.ssim`, averaged over the (C, H, W) dims.
 
-    distance = lpips_tf.lpips(input0, input1)
+    The means, variances and covariance of all the images and channels come
+    out of a single depthwise filtering of the stacked statistics.
+    """
+    batch_shape = a.shape[:-3]
+    a = a.reshape((-1,) + tuple(a.shape[-3:])).float()
+    b = b.reshape((-1,) + tuple(b.shape[-3:])).float()
+    channels = a.shape[1]
+    kernel = gaussian_kernel(filter_size, filter_sigma, device=a.device)
+    stats = gaussian_filter(torch.cat([a, b, a * a, b * b, a * b], dim=1), kernel)
+    mu_a, mu_b, aa, bb, ab = torch.split(stats, channels, dim=1)
+    c1 = (k1 * data_range) ** 2
+    c2 = (k2 * data_range) ** 2
+    mu_ab = mu_a * mu_b
+    mu_aa = mu_a * mu_a
+    mu_bb = mu_b * mu_b
+    luminance = (2 * mu_ab + c1) / (mu_aa + mu_bb + c1)
+    contrast_structure = (2 * (ab - mu_ab) + c2) / ((aa - mu_aa) + (bb - mu_bb) + c2)
+    return torch.mean(luminance * contrast_structure, (-3, -2, -1)).reshape(batch_shape)
+
+
+def lpips(input0, input1, network, sample_ids=None):
+    """
+    Negative LPIPS distance of each image (higher is better, like the other
+    metrics), where `network` is a
+    `video_prediction.models.lpips_network.LPIPS`.
+    """
+    distance = network(input0, input1, sample_ids)
     return -distance
+
+
+METRIC_NAMES = ('psnr', 'mse', 'ssim', 'lpips')
+
+
+def compute_metrics(target, pred, metric_names=None, data_range=1.0, lpips_network=None, sample_ids=None):
+    """
+    Computes several metrics of each frame in one pass. The squared error is
+    shared by mse and psnr, and nothing leaves the device.
+
+    Args:
+        target, pred: tensors of images of shape (..., C, H, W), e.g.
+            (D, N, C, H, W), with values in [0, data_range].
+        metric_names: a subset of `METRIC_NAMES`. Defaults to all of them,
+            except lpips without `lpips_network`.
+        data_range: the range of the values of the images.
+        lpips_network: the `LPIPS` network, required for lpips, which
+            expects images in [0, 1].
+        sample_ids: the ids of the N sequences, used by lpips to cache the
+            features of the target frames.
+
+    Returns:
+        An OrderedDict of the metrics, each of shape target.shape[:-3].
+    """
+    if metric_names is None:
+        metric_names = [name for name in METRIC_NAMES if name != 'lpips' or lpips_network is not None]
+    for metric_name in metric_names:
+        if metric_name not in METRIC_NAMES:
+            raise ValueError('Unknown metric %s' % metric_name)
+    if 'lpips' in metric_names and lpips_network is None:
+        raise ValueError('lpips requires lpips_network')
+    target = target.float()
+    pred = pred.float()
+    metrics = OrderedDict()
+    if 'mse' in metric_names or 'psnr' in metric_names:
+        frame_mse = mse(target, pred)
+    for metric_name in metric_names:
+        if metric_name == 'mse':
+            metrics[metric_name] = frame_mse
+        elif metric_name == 'psnr':
+            metrics[metric_name] = psnr_from_mse(frame_mse, data_range)
+        elif metric_name == 'ssim':
+            metrics[metric_name] = ssim(target, pred, data_range)
+        elif metric_name == 'lpips':
+            metrics[metric_name] = lpips(target, pred, lpips_network, sample_ids)
+    return metrics
+
+
+class MetricAccumulator(object):
+    """
+    Running per-frame averages of metrics of shape (D, N), so that a whole
+    validation set can be streamed through without keeping the predictions.
+    The sums stay on the device of the metrics until `result` is called.
+
+        accumulator = MetricAccumulator()
+        for batch in val_batches:
+            accumulator.update(compute_metrics(target, pred))
+        accumulator.all_reduce()  # when each rank saw a shard of the data
+        frame_metrics = accumulator.result()
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = OrderedDict()
+        self.count = 0
+
+    def update(self, metrics):
+        """
+        Args:
+            metrics: a dict of (D, N) tensors of the same N.
+        """
+        batch_size = None
+        for metric_name, metric in metrics.items():
+            if batch_size is not None and metric.shape[1] != batch_size:
+                raise ValueError('All the metrics must have the same batch size')
+            batch_size = metric.shape[1]
+            metric_sum = metric.detach().double().sum(dim=1)
+            if metric_name in self.sums:
+                self.sums[metric_name] += metric_sum
+            else:
+                self.sums[metric_name] = metric_sum
+        self.count += batch_size or 0
+
+    def all_reduce(self):
+        """
+        Sums the accumulated metrics of all the ranks of the default process
+        group. A no-op without torch.distributed.
+        """
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()) or not self.sums:
+            return
+        names = list(self.sums.keys())
+        sums = torch.stack([self.sums[name] for name in names])
+        count = torch.tensor([self.count], dtype=sums.dtype, device=sums.device)
+        torch.distributed.all_reduce(sums)
+        torch.distributed.all_reduce(count)
+        self.sums = OrderedDict(zip(names, sums))
+        self.count = int(count.item())
+
+    def result(self):
+        """
+        Returns an OrderedDict of the (D,) averages of the metrics over all
+        the sequences seen so far.
+        """
+        return OrderedDict((name, (metric_sum / self.count).float()) for name, metric_sum in self.sums.items())
@@ -0,0 +1,220 @@
+### LPIPS (Zhang et al., 2018) 的 torch 实现，替代 lpips_tf
+### 权重只从本地文件读取，不在运行时下载
+
+import re
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+### torchvision 中 vgg16/alexnet 的 features，层的下标与 torchvision 相同，可以直接加载其权重
+### 只保留到最后一个用到的 relu
+VGG16_CONFIG = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512, 'M', 512, 512, 512]
+NETWORKS = {
+    # taps: indices of the relu layers whose outputs are compared
+    'vgg': dict(taps=(3, 8, 15, 22, 29), channels=(64, 128, 256, 512, 512)),
+    'alex': dict(taps=(1, 4, 7, 9, 11), channels=(64, 192, 384, 256, 256)),
+}
+
+### lpips 中 ScalingLayer 的常数，输入为 [-1, 1]
+SHIFT = [-.030, -.088, -.188]
+SCALE = [.458, .448, .450]
+
+
+def vgg16_features():
+    layers = []
+    in_channels = 3
+    for v in VGG16_CONFIG:
+        if v == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            layers += [nn.Conv2d(in_channels, v, kernel_size=3, padding=1), nn.ReLU()]
+            in_channels = v
+    return nn.Sequential(*layers)
+
+
+def alexnet_features():
+    return nn.Sequential(
+        nn.Conv2d(3, 64, kernel_size=11, stride=4, padding=2), nn.ReLU(),
+        nn.MaxPool2d(kernel_size=3, stride=2),
+        nn.Conv2d(64, 192, kernel_size=5, padding=2), nn.ReLU(),
+        nn.MaxPool2d(kernel_size=3, stride=2),
+        nn.Conv2d(192, 384, kernel_size=3, padding=1), nn.ReLU(),
+        nn.Conv2d(384, 256, kernel_size=3, padding=1), nn.ReLU(),
+        nn.Conv2d(256, 256, kernel_size=3, padding=1), nn.ReLU())
+
+
+def convert_state_dict(state_dict):
+    """
+    Renames the weights of the checkpoints of torchvision (`features.<i>.*`)
+    and of the lpips package (`net.slice<k>.<i>.*`, `lin<k>.model.1.weight`
+    or `lins.<k>.model.1.weight`) to the names of `LPIPS`. The other weights
+    (e.g. the classifier of torchvision) are dropped.
+    """
+    patterns = [
+        (re.compile(r'^(?:net\.)?(?:slice\d+|features)\.(\d+)\.(weight|bias)$'), r'features.\1.\2'),
+        (re.compile(r'^lin(\d+)\.model\.1\.weight$'), r'lins.\1.weight'),
+        (re.compile(r'^lins\.(\d+)\.(?:model\.1\.)?weight$'), r'lins.\1.weight'),
+    ]
+    converted = OrderedDict()
+    for name, value in state_dict.items():
+        for pattern, repl in patterns:
+            if pattern.match(name):
+                converted[pattern.sub(repl, name)] = value
+                break
+    return converted
+
+
+def normalize_features(x, eps=1e-10):
+    ### 沿 channel 归一化；在 float32 中计算，half 时 eps 不会下溢为 0
+    norm = torch.sqrt(torch.sum(x.float() ** 2, dim=1, keepdim=True)) + eps
+    return (x.float() / norm).to(x.dtype)
+
+
+class LPIPS(nn.Module):
+    """
+    Learned perceptual image patch similarity ("net-lin", version 0.1), with
+    an AlexNet or VGG16 backbone.
+
+    All the frames of a call go through the backbone in a single batch,
+    under `torch.inference_mode`. When `sample_ids` are given, the features
+    of the target frames are cached by sample id, so that repeated passes
+    over the same validation set only run the backbone on the predicted
+    frames.
+
+        lpips = LPIPS('alex', ['alexnet-owt-7be5be79.pth', 'alex.pth']).to(device)
+        distance = lpips(target_images, gen_images, sample_ids)  # (D, N)
+    """
+    def __init__(self, net='alex', weights_path=None, half=False, max_cache_size=10000):
+        """
+        Args:
+            net: 'alex' or 'vgg'.
+            weights_path: a local file, or a list of local files, with the
+                weights of the backbone and of the linear layers, e.g. the
+                torchvision checkpoint of the backbone and the lpips
+                checkpoint of the linear layers, or the state_dict of a
+                `lpips.LPIPS` or of this module.
+            half: whether to run the backbone in float16 (meant for gpus).
+            max_cache_size: the maximum number of samples whose target
+                features are cached. The least recently used are evicted.
+        """
+        super(LPIPS, self).__init__()
+        if net not in NETWORKS:
+            raise ValueError('Invalid net %s' % net)
+        if weights_path is None:
+            raise ValueError('weights_path is required, the weights are never downloaded')
+        self.net = net
+        self.taps = NETWORKS[net]['taps']
+        self.features = vgg16_features() if net == 'vgg' else alexnet_features()
+        self.lins = nn.ModuleList([nn.Conv2d(channels, 1, kernel_size=1, bias=False)
+                                   for channels in NETWORKS[net]['channels']])
+        self.register_buffer('shift', torch.tensor(SHIFT).view(1, 3, 1, 1), persistent=False)
+        self.register_buffer('scale', torch.tensor(SCALE).view(1, 3, 1, 1), persistent=False)
+
+        if isinstance(weights_path, str):
+            weights_path = [weights_path]
+        state_dict = OrderedDict()
+        for path in weights_path:
+            state_dict.update(convert_state_dict(torch.load(path, map_location='cpu')))
+        self.load_state_dict(state_dict)
+
+        self.use_half = half
+        if half:
+            self.features.half()
+            self.lins.half()
+        self.eval()
+        self.requires_grad_(False)
+        self.max_cache_size = max_cache_size
+        self._cache = OrderedDict()
+
+    def train(self, mode=True):
+        ### 没有 dropout 和 batchnorm，始终处于 eval 模式
+        return super(LPIPS, self).train(False)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def preprocess(self, images):
+        ### [0, 1] -> [-1, 1] -> ScalingLayer
+        if images.shape[1] == 1:
+            images = images.expand(-1, 3, -1, -1)
+        images = (images.float() * 2 - 1 - self.shift) / self.scale
+        return images.half() if self.use_half else images
+
+    def extract_features(self, images):
+        """
+        Args:
+            images: a (B, C, H, W) tensor with values in [0, 1].
+
+        Returns:
+            A list of the normalized features of the tapped layers.
+        """
+        features = []
+        x = self.preprocess(images)
+        for i, layer in enumerate(self.features):
+            x = layer(x)
+            if i in self.taps:
+                features.append(normalize_features(x))
+        return features
+
+    def distance_from_features(self, features0, features1):
+        distance = 0
+        for lin, f0, f1 in zip(self.lins, features0, features1):
+            distance = distance + torch.mean(lin((f0 - f1) ** 2).float(), (-3, -2, -1))
+        return distance
+
+    def forward(self, target, pred, sample_ids=None):
+        """
+        Args:
+            target, pred: tensors of images of shape (..., C, H, W) with
+                values in [0, 1]. With `sample_ids`, the shape has to be
+                (D, N, C, H, W).
+            sample_ids: None, or N ids (e.g. the `sample_id` of the batches
+                of `BaseVideoDataset`, which also depends on the time slice)
+                that identify the target frames of each sequence across
+                calls. The same id must always stand for the same frames.
+
+        Returns:
+            The distance of each frame, of shape pred.shape[:-3].
+        """
+        batch_shape = pred.shape[:-3]
+        with torch.inference_mode():
+            pred = pred.reshape((-1,) + tuple(pred.shape[-3:]))
+            if sample_ids is None:
+                target = target.reshape(pred.shape)
+                features = self.extract_features(torch.cat([target, pred]))
+                target_features = [f[:len(pred)] for f in features]
+                pred_features = [f[len(pred):] for f in features]
+            else:
+                target_features, pred_features = self._cached_features(target, pred, sample_ids)
+            distance = self.distance_from_features(target_features, pred_features)
+        return distance.reshape(batch_shape)
+
+    def _cached_features(self, target, pred, sample_ids):
+        sequence_length = target.shape[0]
+        sample_ids = [int(sample_id) for sample_id in sample_ids]
+        if len(sample_ids) != target.shape[1]:
+            raise ValueError('Expected %d sample ids, but %d given' % (target.shape[1], len(sample_ids)))
+        missing = OrderedDict()
+        for j, sample_id in enumerate(sample_ids):
+            if sample_id not in self._cache and sample_id not in missing:
+                missing[sample_id] = j
+        ### 缺少的 target 帧和所有的预测帧拼成一个 batch，backbone 只跑一次
+        images = [pred]
+        if missing:
+            missing_target = target[:, list(missing.values())]
+            images.insert(0, missing_target.reshape((-1,) + tuple(target.shape[-3:])))
+        features = self.extract_features(torch.cat(images))
+        num_missing = sequence_length * len(missing)
+        pred_features = [f[num_missing:] for f in features]
+        for k, sample_id in enumerate(missing):
+            self._cache[sample_id] = [f[:num_missing].unflatten(0, (sequence_length, len(missing)))[:, k].clone()
+                                      for f in features]
+        cached = []
+        for sample_id in sample_ids:
+            self._cache.move_to_end(sample_id)
+            cached.append(self._cache[sample_id])
+        target_features = [torch.stack([c[i] for c in cached], dim=1).flatten(0, 1) for i in range(len(self.taps))]
+        while len(self._cache) > self.max_cache_size:
+            self._cache.popitem(last=False)
+        return target_features, pred_features
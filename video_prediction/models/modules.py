@@ -17,8 +17,12 @@ from video_prediction.utils.util import maybe_pad_or_slice
 #from video_prediction.utils.max_sv import spectral_normed_weight
 #from video_prediction.layers.conv import Conv2d, Conv3d
 
-import video_prediction.globalvar as gl
-device = gl.get_value()   ### 获取全局device 6/8
+def conv_output_size(input_size, conv):
+    ### 按 conv 的 kernel_size/stride/padding/dilation 计算输出的空间尺寸，input_size 不含 batch 和 channel 维
+    return [(size + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+            for size, kernel_size, stride, padding, dilation
+            in zip(input_size, conv.kernel_size, conv.stride, conv.padding, conv.dilation)]
+
 
 ### 可用 spectral_norm(nn.Linear()) 代替 6/5
 class Dense(nn.Module):
@@ -128,10 +132,12 @@ class ImageDiscriminator(nn.Module):
         self.conv6 = spectral_norm(nn.Conv2d(in_channels=ndf*8,
                             out_channels=ndf*8, kernel_size=3, stride=1, padding=(1,1)))
         
-        ### dense 的 input_shape 受到前面卷积层的影响，暂时无法确定 5/19
-        #in_channel = torch.prod(self.input_shape[1:])   ### 去掉第一个维度后余下所有维度尺寸的乘积 5/19
-        #self.dense = Dense(in_channel, out_channels=1, use_spectral_norm=True)
-        self.dense = None
+        ### dense 的 input_shape 由前面卷积层的输出尺寸决定，在这里直接算出来 5/19
+        ### 不再在 forward 里第一次运行时才创建，optimizer 构建时就能拿到全部参数
+        output_size = list(self.input_shape[-2:])
+        for conv in [self.conv0, self.conv1, self.conv2, self.conv3, self.conv4, self.conv5, self.conv6]:
+            output_size = conv_output_size(output_size, conv)
+        self.dense = spectral_norm(nn.Linear(in_features=ndf * 8 * int(np.prod(output_size)), out_features=1))
         
         
     def forward(self, inputs):
@@ -167,10 +173,6 @@ class ImageDiscriminator(nn.Module):
         #outputs['sn_conv3_0'] = output     ### for visualization 5/8
         outputs.append(output)
         output = output.reshape([output.shape[0],-1])   ### to [batch, -1] 5/19
-        if self.dense is None:
-            output_shape = output.shape
-            self.dense = spectral_norm(nn.Linear(in_features=torch.prod(torch.tensor(output_shape[1:])),
-                                                 out_features=1)).cuda(device)   ### !!! 6/8
         output = self.dense(output)
         #outputs['output'] = output
         outputs.append(output)
@@ -200,11 +202,11 @@ class VideoDiscriminator(nn.Module):
         self.conv6 = spectral_norm(nn.Conv3d(in_channels=ndf*8,
                             out_channels=ndf*8, kernel_size=3, stride=1, padding=(1,1,1)))
         
-        ### input_shape 不确定 5/19
-        #from functools import reduce
-        #ln = reduce(lambda x,y:x * y, self.input_shape[1:])
-        #self.dense = Dense(ln, out_channels=1, use_spectral_norm=True)
-        self.dense = None
+        ### 由 input_shape 算出卷积层的输出尺寸，确定 dense 的 in_features 5/19
+        output_size = list(self.input_shape[-3:])
+        for conv in [self.conv0, self.conv1, self.conv2, self.conv3, self.conv4, self.conv5, self.conv6]:
+            output_size = conv_output_size(output_size, conv)
+        self.dense = spectral_norm(nn.Linear(in_features=ndf * 8 * int(np.prod(output_size)), out_features=1))
         
         
     def forward(self, inputs):
@@ -240,13 +242,6 @@ class VideoDiscriminator(nn.Module):
         #outputs['sn_conv3_0'] = output     ### for visualization 5/8
         outputs.append(output)
         output = output.reshape([output.shape[0],-1])   ### to [batch, -1] 5/19
-        if self.dense is None:
-            output_shape = output.shape
-            self.dense = spectral_norm(nn.Linear(in_features=torch.prod(torch.tensor(output_shape[1:])),
-                                                 out_features=1)).cuda(device)  ### !!! 6/8
-        #print(output)   ### 6/8
-        #output = output.cuda(device)  ### 6/8
-        #print(output)   ### 6/8
         output = self.dense(output)
         #outputs['output'] = output
         outputs.append(output)
@@ -283,16 +278,18 @@ class Posterior(nn.Module):
         ### inputs应当是 NDCHW 5/16
         outputs = {}
         inputs = torch.cat([inputs[:-1], inputs[1:]], dim=-3)  ### 将连续的两帧图片在channel维度上级联 5/16
+        ### z 的形状取自输入，不受构造时的 sequence_length 和 batch_size 约束 
+        zs_shape = list(inputs.shape[:2]) + [-1]
         inputs = inputs.reshape([-1]+list(inputs.shape[-3:]))  ### 变为 NCHW 5/22
         ### 加入 action uncompleted ... 
         h = self.encoder(inputs)['output']
         if self.use_e_rnn:
             h = self.dense0(h)
             h = self.rnn(h)
-        z_mu = self.dense1(h).reshape([self.input_shape[0]-1]+[self.input_shape[1]]+[-1])
+        z_mu = self.dense1(h).reshape(zs_shape)
         outputs['zs_mu'] = z_mu
-        z_log_sigma_sq = self.dense2(h).reshape([self.input_shape[0]-1]+[self.input_shape[1]]+[-1])
-        z_log_sigma_sq = torch.clamp(z_log_sigma_sq, -10,10)
+        z_log_sigma_sq = self.dense2(h).reshape(zs_shape)
+        z_log_sigma_sq = torch.clamp(z_log_sigma_sq.float(), -10,10)   ### 固定为 fp32，不受 autocast 影响
         outputs['zs_log_sigma_sq'] = z_log_sigma_sq
         return outputs
     
@@ -354,8 +351,8 @@ class Prior(nn.Module):
         h = self.encoder(inputs)['output']
         h = h.reshape(self.concat_shape[0:2]+[-1])
         
-        h_zeros = torch.zeros(size=[self.hparams.sequence_length-self.hparams.context_frames] + 
-                              list(h.shape[1:])).cuda(device)
+        h_zeros = h.new_zeros(size=[self.hparams.sequence_length-self.hparams.context_frames] + 
+                              list(h.shape[1:]))
         h = torch.cat([h, h_zeros], dim=0)
         
         h = h.reshape([-1, h.size(-1)])
@@ -367,7 +364,7 @@ class Prior(nn.Module):
         z_mu = self.dense1(h).reshape(self.concat_shape[0:2]+[-1])
         outputs['zs_mu'] = z_mu
         z_log_sigma_sq = self.dense2(h).reshape(self.concat_shape[0:2]+[-1])
-        z_log_sigma_sq = torch.clamp(z_log_sigma_sq, -10,10)
+        z_log_sigma_sq = torch.clamp(z_log_sigma_sq.float(), -10,10)   ### 固定为 fp32，不受 autocast 影响
         outputs['zs_log_sigma_sq'] = z_log_sigma_sq
         return outputs
         
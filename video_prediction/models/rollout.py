@@ -0,0 +1,223 @@
+### 在线推理：逐帧输入观测到的图像，随时预测之后的 k 帧
+### 每输入一帧只运行一步 SAVPCell，不需要从 t=0 重新展开
+
+import torch
+
+from video_prediction.utils.checkpoint import to_cpu
+from video_prediction.utils.prefetcher import to_device
+
+
+def concat_state(values):
+    ### 所有 tensor 的第 0 维都是 batch，沿第 0 维拼接；time 等整数取最大值
+    first = values[0]
+    if first is None:
+        return None
+    if isinstance(first, torch.Tensor):
+        return torch.cat(values)
+    if isinstance(first, dict):
+        return type(first)((k, concat_state([value[k] for value in values])) for k in first)
+    if isinstance(first, (list, tuple)):
+        return type(first)(concat_state(list(value)) for value in zip(*values))
+    return max(values)
+
+
+def split_state(value, sizes):
+    if value is None:
+        return [None] * len(sizes)
+    if isinstance(value, torch.Tensor):
+        return list(torch.split(value, sizes))
+    if isinstance(value, dict):
+        parts = {k: split_state(v, sizes) for k, v in value.items()}
+        return [type(value)((k, parts[k][i]) for k in value) for i in range(len(sizes))]
+    if isinstance(value, (list, tuple)):
+        parts = [split_state(v, sizes) for v in value]
+        return [type(value)(part[i] for part in parts) for i in range(len(sizes))]
+    return [value] * len(sizes)
+
+
+class Rollout(object):
+    """
+    Incremental autoregressive inference with the `SAVPCell` of a
+    `SAVPModel`, for N sequences whose frames arrive one at a time.
+
+    The first `context_frames` frames are buffered. Once they are all
+    there, the cell is run over them, with the zs of the posterior as in
+    training. After that, every `step` runs a single cell step on the
+    previous frame, carrying the `rnn_z_state`, `conv_rnn_states` and
+    `last_images` of the cell. `predict(k)` unrolls k steps from the current
+    state, feeding back the generated images with zs from the prior, and
+    leaves the state unchanged. Observed frames after the context replace
+    the generated images as the inputs of the cell.
+
+        rollout = Rollout(model, batch_size=1)
+        for image in frames:                    # (N, C, H, W) in [0, 1]
+            rollout.step(image)
+            if rollout.started:
+                gen_images = rollout.predict(k)  # (k, N, C, H, W)
+
+    The state can be moved to another worker with `state_dict` and
+    `load_state_dict`. Started rollouts of different streams can be
+    batched with `Rollout.concat` and scattered back with `split`.
+    """
+    def __init__(self, model, batch_size=1):
+        """
+        Args:
+            model: a `SAVPModel`.
+            batch_size: the number N of sequences.
+        """
+        if model.hparams.learn_prior:
+            raise ValueError('Rollout does not support learn_prior, the learned prior needs the whole clip')
+        self.model = model
+        self.hparams = model.hparams
+        self.generator = model.generator
+        self.cell = model.generator.generator.savpcell
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        ### 前 context_frames 帧，cell 中的 background 会用到
+        self.context_images = []
+        ### 最后观测到的一帧，还没有输入 cell
+        self.last_image = None
+        self.states = None
+        self.num_frames = 0
+
+    @property
+    def started(self):
+        return self.states is not None
+
+    @property
+    def context(self):
+        return torch.stack(self.context_images)
+
+    def prior_zs(self, num_steps):
+        return torch.randn([num_steps, self.batch_size, self.hparams.nz],
+                           device=self.model.device, dtype=self.model.dtype)
+
+    def cell_step(self, states, image, z):
+        """
+        Runs one step of the cell from `states`. `image` is the observed
+        input frame, or None to feed back the last generated image.
+
+        Returns:
+            A tuple of the generated image and the new states.
+        """
+        states = dict(states)
+        if image is None:
+            image = states['gen_image']
+        else:
+            ### cell 在 time >= context_frames 时使用 gen_image，观测到的帧同时放在两处
+            states['gen_image'] = image
+        output, new_states = self.cell({'images': image, 'zs': z}, states, self.context)
+        states.update(new_states)
+        return output['gen_images'], states
+
+    def start(self):
+        ### context 帧到齐后，用 posterior 的 z 展开 context 部分，与训练时相同
+        context = self.context
+        states = self.generator.generator.state_arena.initial_states(self.batch_size, context.device, context.dtype)
+        states['last_images'] = [context[0]] * self.hparams.last_frames
+        if len(context) > 1:
+            outputs_posterior = self.generator.encoder(context)
+            eps = torch.randn_like(outputs_posterior['zs_mu'])
+            zs = outputs_posterior['zs_mu'] + torch.sqrt(torch.exp(outputs_posterior['zs_log_sigma_sq'])) * eps
+            for image, z in zip(context[:-1], zs):
+                _, states = self.cell_step(states, image, z)
+        self.states = states
+
+    def step(self, images):
+        """
+        Feeds the next observed frame of the N sequences.
+
+        Args:
+            images: a (N, C, H, W) tensor with values in [0, 1].
+
+        Returns:
+            The (N, C, H, W) prediction of `images` from the previous
+            frames, or None while the context frames are fed.
+        """
+        images = images.to(self.model.device, self.model.dtype)
+        if images.shape[0] != self.batch_size:
+            raise ValueError('Expected a batch of %d images, but %d given' % (self.batch_size, images.shape[0]))
+        gen_images = None
+        with torch.no_grad(), self.model.autocast():
+            if not self.started:
+                self.context_images.append(images)
+                if len(self.context_images) == self.hparams.context_frames:
+                    self.start()
+            else:
+                gen_images, self.states = self.cell_step(self.states, self.last_image, self.prior_zs(1)[0])
+        self.last_image = images
+        self.num_frames += 1
+        return gen_images
+
+    def predict(self, k):
+        """
+        Predicts the next `k` frames without changing the state.
+
+        Returns:
+            A (k, N, C, H, W) tensor.
+        """
+        if not self.started:
+            raise ValueError('predict needs context_frames=%d frames, but only %d were given' %
+                             (self.hparams.context_frames, self.num_frames))
+        states = self.states
+        image = self.last_image
+        gen_images = []
+        with torch.no_grad(), self.model.autocast():
+            for z in self.prior_zs(k):
+                gen_image, states = self.cell_step(states, image, z)
+                gen_images.append(gen_image)
+                image = None
+        return torch.stack(gen_images)
+
+    def get_state(self):
+        return {'num_frames': self.num_frames,
+                'context_images': self.context_images,
+                'last_image': self.last_image,
+                'states': self.states}
+
+    def set_state(self, state):
+        self.num_frames = state['num_frames']
+        self.context_images = list(state['context_images'])
+        self.last_image = state['last_image']
+        self.states = state['states']
+        if self.context_images:
+            self.batch_size = self.context_images[0].shape[0]
+
+    def state_dict(self):
+        ### 拷贝到 cpu，可以直接 torch.save 或发送给其他 worker
+        return to_cpu(self.get_state())
+
+    def load_state_dict(self, state_dict):
+        self.set_state(to_device(state_dict, self.model.device))
+
+    @classmethod
+    def concat(cls, rollouts):
+        """
+        Returns a rollout of all the sequences of the started `rollouts`,
+        so that their steps run as one batch.
+
+        The cell only uses its time step to choose between the observed and
+        the generated image, which `cell_step` makes irrelevant, so rollouts
+        at different time steps can be batched. The time steps and
+        num_frames of the result are the largest ones.
+        """
+        if not all(rollout.started for rollout in rollouts):
+            raise ValueError('Only started rollouts can be concatenated')
+        rollout = cls(rollouts[0].model, batch_size=sum(rollout.batch_size for rollout in rollouts))
+        rollout.set_state(concat_state([rollout.get_state() for rollout in rollouts]))
+        return rollout
+
+    def split(self, sizes=None):
+        """
+        Splits the sequences into rollouts of `sizes` sequences (by default
+        one rollout per sequence), the inverse of `concat`.
+        """
+        sizes = sizes or [1] * self.batch_size
+        rollouts = []
+        for state in split_state(self.get_state(), sizes):
+            rollout = type(self)(self.model, batch_size=state['context_images'][0].shape[0])
+            rollout.set_state(state)
+            rollouts.append(rollout)
+        return rollouts
@@ -5,25 +5,24 @@ import functools
 import itertools
 import os
 import re
-import copy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
 import collections
 from collections import OrderedDict
-from tensorflow.contrib.training import HParams
 import video_prediction as vp
+import video_prediction.losses
+import video_prediction.metrics
 from video_prediction.utils import util
+from video_prediction.utils.hparams import HParams
 #from video_prediction.utils.max_sv import spectral_normed_weight
 #from video_prediction.layers.conv import Conv2d, Conv3d
 from video_prediction.layers.convLSTM import ConvLSTMCell
 from video_prediction.models.modules import Dense, Prior, Posterior, Encoder, ImageDiscriminator, VideoDiscriminator
 
-import video_prediction.globalvar as gl
-device = gl.get_value()   ### 获取全局device 6/8
-
 ### 测试基本通过 6/5
 ### video_discrim 的 N 和 D 维度似乎反了 6/5
 class DiscriminatorGivenVideo(nn.Module):
@@ -40,25 +39,32 @@ class DiscriminatorGivenVideo(nn.Module):
         ### video_discrim  input_shape = CDHW 6/5
         video_discrim_input_shape = [self.input_shape[-3]] + [self.clip_length] + self.input_shape[-2:]
         self.video_discrim_1 = VideoDiscriminator(video_discrim_input_shape, ndf=hparams.ndf)
+        ### loss 权重为 0 的 discriminator 不会被用到，不需要梯度，DDP 也就不会等待它们的梯度
+        for discrim, weights in [(self.image_discrim_0, [hparams.image_sn_gan_weight, hparams.image_sn_vae_gan_weight]),
+                                 (self.video_discrim_1, [hparams.video_sn_gan_weight, hparams.video_sn_vae_gan_weight]),
+                                 (self.image_discrim_1, [hparams.images_sn_gan_weight, hparams.images_sn_vae_gan_weight])]:
+            if not any(weights):
+                discrim.requires_grad_(False)
         
         
-    def forward(self, inputs):
+    def forward(self, inputs, generator=None):
         ### inputs是来自generator的outputs['gen_images'] 6/5
         ### inputs.shape = DNCHW 6/5
-        inputs = inputs.cuda(device)   ### 6/8
+        ### generator 是可选的 torch.Generator，用于复现随机采样，需要和 inputs 在同一个 device 上
         sequence_length, batch_size = inputs.shape[:2]
+        batch_index = torch.arange(batch_size, device=inputs.device)
         
         ### 每个序列都随机抽取一帧送入 discriminator 6/5
-        t_sample = torch.randint(high=sequence_length, size=(batch_size,)).cuda(device)  ### cuda 6/8
-        samples = torch.split(inputs, 1, dim=1)
-        #image_sample = torch.cat([torch.index_select(sample, dim=0, index = torch.tensor([idx]))
-        #                for idx,sample in zip(t_sample,samples)], dim=1)
-        image_sample = torch.cat([sample[idx] for idx,sample in zip(t_sample,samples)], dim=0)
+        ### 用 index tensor 一次 gather 出来，不再逐个样本切片（每次都要同步 GPU）
+        t_sample = torch.randint(high=sequence_length, size=(batch_size,), device=inputs.device, generator=generator)
+        image_sample = inputs[t_sample, batch_index]   ### NCHW
         
         ### 每个序列采样一个子序列送入 discriminator 6/5
         ### 同时再将序列中的每个图片送入 discriminator 6/5
-        t_start = torch.randint(high=sequence_length - self.clip_length + 1, size=(batch_size,)).cuda(device)  ### 6/8
-        clip_sample = torch.cat([sample[idx:idx+self.clip_length] for idx,sample in zip(t_start,samples)], dim=1)
+        t_start = torch.randint(high=sequence_length - self.clip_length + 1, size=(batch_size,),
+                                device=inputs.device, generator=generator)
+        t_clip = t_start + torch.arange(self.clip_length, device=inputs.device)[:, None]   ### (clip_length, N)
+        clip_sample = inputs[t_clip, batch_index]   ### DNCHW
         
         outputs = {}
         if self.hparams.image_sn_gan_weight or self.hparams.image_sn_vae_gan_weight:
@@ -101,25 +107,27 @@ class Discriminator(nn.Module):
         self.discriminator = DiscriminatorGivenVideo(self.image_shape[-3:], hparams)
         
         
-    def forward(self, inputs, outputs):
-        #inputs = {k:v.cuda(device) for k,v in inputs.items()}   ### 6/8
-        #outputs = {k:v.cuda(device) for k,v in outputs.items()}
-        images_enc_real = inputs['images'][1:]#.cuda(device)     ### 6/8
-        images_enc_fake = outputs['gen_images_enc']#.cuda(device)
-        discrim_outputs_enc_real = self.discriminator(images_enc_real)
-        discrim_outputs_enc_fake = self.discriminator(images_enc_fake)
-        images_real = inputs['images'][1:]
-        images_fake = outputs['gen_images']
-        discrim_outputs_real = self.discriminator(images_real)
-        discrim_outputs_fake = self.discriminator(images_fake)
-        
-        discrim_outputs_real = OrderedDict([(k + '_real', v) for k, v in discrim_outputs_real.items()])
-        discrim_outputs_fake = OrderedDict([(k + '_fake', v) for k, v in discrim_outputs_fake.items()])
-        discrim_outputs_enc_real = OrderedDict([(k + '_enc_real', v) for k, v in discrim_outputs_enc_real.items()])
-        discrim_outputs_enc_fake = OrderedDict([(k + '_enc_fake', v) for k, v in discrim_outputs_enc_fake.items()])
-        
-        outputs = [discrim_outputs_real, discrim_outputs_fake,
-                   discrim_outputs_enc_real, discrim_outputs_enc_fake]
+    def forward(self, inputs, outputs, generator=None):
+        ### real, fake 和 enc_fake 沿 batch 维拼接，discriminator 只运行一次
+        ### enc_real 与 real 的输入都是 inputs['images'][1:]，直接共用 real 的结果
+        images = [inputs['images'][1:], outputs['gen_images']]
+        suffixes = ['_real', '_fake']
+        if 'gen_images_enc' in outputs:
+            images.append(outputs['gen_images_enc'])
+            suffixes.append('_enc_fake')
+        split_sizes = [image.shape[1] for image in images]
+        discrim_outputs = self.discriminator(torch.cat(images, dim=1), generator=generator)
+        ### discrim_images_sn_* 是 DN... 的，其余是 N... 的
+        discrim_outputs = OrderedDict([
+            (k, torch.split(v, split_sizes, dim=1 if k.startswith('discrim_images_sn') else 0))
+            for k, v in discrim_outputs.items()])
+        discrim_outputs = OrderedDict(zip(suffixes, [OrderedDict([(k, v[i]) for k, v in discrim_outputs.items()])
+                                                    for i in range(len(suffixes))]))
+        if '_enc_fake' in discrim_outputs:
+            discrim_outputs['_enc_real'] = discrim_outputs['_real']
+        
+        outputs = [OrderedDict([(k + suffix, v) for k, v in discrim_outputs[suffix].items()])
+                   for suffix in ['_real', '_fake', '_enc_real', '_enc_fake'] if suffix in discrim_outputs]
         total_num_outputs = sum([len(output) for output in outputs])
         outputs = collections.OrderedDict(itertools.chain(*[output.items() for output in outputs]))
         assert len(outputs) == total_num_outputs  # ensure no output is lost because of repeated keys
@@ -374,9 +382,40 @@ class SAVPCell(nn.Module):
                         kernel_size=3,
                         stride=1,
                         padding=(1,1))]
-        self.masks += [nn.Softmax()]
-        
-        
+        self.masks += [nn.Softmax(dim=1)]
+        
+        
+    def apply_conv_stack(self, layers, h, z):
+        ### 相当于 h = tile_concat([h, z]) 之后依次经过 layers
+        ### fold_z_into_conv 时 z 不在空间上复制，而是在第一个 conv 里折叠成逐样本的 bias
+        ### bilinear upsample 不改变空间上为常数的 z，所以 z 可以越过 conv 前面的 Upsample
+        if not self.hparams.fold_z_into_conv:
+            h = util.tile_concat([h, z[:, :, None, None]], axis=1)
+            for layer in layers:
+                h = layer(h)
+            return h
+        z_folded = False
+        for layer in layers:
+            if not z_folded and isinstance(layer, nn.Conv2d):
+                h = util.conv2d_tile_concat(layer, h, z, z_start=h.shape[1])
+                z_folded = True
+            else:
+                assert z_folded or isinstance(layer, nn.Upsample)
+                h = layer(h)
+        return h
+    
+    def apply_conv_rnn(self, rnn, h, z, state):
+        ### 相当于 rnn(tile_concat([h, z]), state)
+        if self.hparams.fold_z_into_conv:
+            return rnn(h, state, z=z)
+        return rnn(util.tile_concat([h, z[:, :, None, None]], axis=1), state)
+    
+    def checkpoint_block(self, function, *args):
+        ### checkpoint_policy=blocks 时不保存 block 内部的激活，backward 时重新计算
+        if self.hparams.checkpoint_policy == 'blocks' and torch.is_grad_enabled():
+            return checkpoint(function, *args, use_reentrant=False)
+        return function(*args)
+    
     def forward(self, inputs, states, all_images):
         #print('SAVPCell conv_rnn_state_sizes', self.conv_rnn_state_sizes[0])   ### 6/3
         ### inputs = {'images':(NCHW), 'zs':(N,nz),} 5/28
@@ -406,26 +445,21 @@ class SAVPCell(nn.Module):
         ### 第 0 层 5/29
         ### all_images 代替原来的 self.inputs['images'][0] 5/29
         h = torch.cat([image, all_images[0]], dim=1)  ### h = (N,C*2,H,W) 5/29
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)  ### h = (N, C*2+hparams.nz, H,W) 5/29
-        for layer in self.encoder_0_conv:
-            h = layer(h)
+        h = self.checkpoint_block(self.apply_conv_stack, self.encoder_0_conv, h, state_action_z)  ### 拼接 z 后 h = (N, C*2+hparams.nz, H,W) 5/29
         layers.append((h,))   ### h=(N, hparams.hgf, H/2, W/2) 5/29
         #print('encoder_0: h   ',h.shape)   ### for debug 6/2
         #print('-'*20)
         ### 第 1 层 5/29
         h = layers[-1][-1]
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)### h=(N,hparams.rgf+hparams.nz,H/2,W/2) 5/29
+        h = self.checkpoint_block(self.apply_conv_stack, self.encoder_1_conv, h, state_action_z)### 拼接 z 后 h=(N,hparams.rgf+hparams.nz,H/2,W/2) 5/29
         #print('encoder_1_conv input: state_action_z  ', state_action_z[:,:,None,None].shape)
         #print('encoder_1_conv input: h_cat  ', h.shape) ### 6/2
-        for layer in self.encoder_1_conv:
-            h = layer(h)
         #print('encoder_1_conv output: h  ', h.shape)  ### 6/2
-        conv_rnn_h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
         conv_rnn_state = conv_rnn_states[len(new_conv_rnn_states)]
         #print('encoder_1_rnn input: conv_rnn_h  ', conv_rnn_h.shape)  ### 6/2
         #print('encoder_1_rnn state: conv_rnn_state  ', conv_rnn_state[0].shape, conv_rnn_state[1].shape)  ### 6/2
         ### conv_rnn_h, conv_rnn_state 换为 hx,cx 6/2
-        hx, cx = self.encoder_1_rnn(conv_rnn_h, conv_rnn_state)  ### 为什么是这样？ 5/29
+        hx, cx = self.checkpoint_block(self.apply_conv_rnn, self.encoder_1_rnn, h, state_action_z, conv_rnn_state)  ### 为什么是这样？ 5/29
         conv_rnn_state = (hx, cx)
         conv_rnn_h = hx
         new_conv_rnn_states.append(conv_rnn_state)
@@ -433,26 +467,21 @@ class SAVPCell(nn.Module):
         #print('-'*20)   ### 6/2
         ### 第 2 层 5/29
         h = layers[-1][-1]
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)  ### h=(N,out_channel+hparams.nz,h',w') 5/29
-        for layer in self.encoder_2_conv:
-            h = layer(h)
-        conv_rnn_h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
+        h = self.checkpoint_block(self.apply_conv_stack, self.encoder_2_conv, h, state_action_z)  ### 拼接 z 后 h=(N,out_channel+hparams.nz,h',w') 5/29
         conv_rnn_state = conv_rnn_states[len(new_conv_rnn_states)]
         ### conv_rnn_h, conv_rnn_state 换为 hx,cx 6/2
-        hx, cx = self.encoder_2_rnn(conv_rnn_h, conv_rnn_state)  ### 为什么是这样？ 5/29
+        hx, cx = self.checkpoint_block(self.apply_conv_rnn, self.encoder_2_rnn, h, state_action_z, conv_rnn_state)  ### 为什么是这样？ 5/29
         conv_rnn_state = (hx, cx)
         conv_rnn_h = hx
         new_conv_rnn_states.append(conv_rnn_state)
         layers.append((h, conv_rnn_h))
         ### 第 3 层 5/29
         h = layers[-1][-1]
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
-        for layer in self.encoder_3_conv:
-            h = layer(h)
-        conv_rnn_h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
+        h = self.checkpoint_block(self.apply_conv_stack, self.encoder_3_conv, h, state_action_z)
         conv_rnn_state = conv_rnn_states[len(new_conv_rnn_states)]
         ### conv_rnn_h, conv_rnn_state 换为 hx,cx 6/2
-        hx, cx = self.encoder_3_rnn(conv_rnn_h, conv_rnn_state)
+        hx, cx = self.checkpoint_block(self.apply_conv_rnn, self.encoder_3_rnn, h, state_action_z, conv_rnn_state)
+        conv_rnn_state = (hx, cx)
         conv_rnn_h = hx
         new_conv_rnn_states.append(conv_rnn_state)
         layers.append((h, conv_rnn_h))
@@ -460,41 +489,31 @@ class SAVPCell(nn.Module):
         ############### decoder ###############
         ### 第 4 层 5/29
         h = layers[-1][-1]
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
-        for layer in self.decoder_4_conv:
-            h = layer(h)
-        conv_rnn_h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
+        h = self.checkpoint_block(self.apply_conv_stack, self.decoder_4_conv, h, state_action_z)
         conv_rnn_state = conv_rnn_states[len(new_conv_rnn_states)]
         ### conv_rnn_h, conv_rnn_state 换为 hx,cx 6/2
-        hx, cx = self.decoder_4_rnn(conv_rnn_h, conv_rnn_state)
+        hx, cx = self.checkpoint_block(self.apply_conv_rnn, self.decoder_4_rnn, h, state_action_z, conv_rnn_state)
         conv_rnn_state = (hx, cx)
         conv_rnn_h = hx
         new_conv_rnn_states.append(conv_rnn_state)
         layers.append((h, conv_rnn_h))
         ### 第 5 层 5/29
         h = torch.cat([layers[-1][-1], layers[2][-1]], dim=1)
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
-        for layer in self.decoder_5_conv:
-            h = layer(h)
-        conv_rnn_h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
+        h = self.checkpoint_block(self.apply_conv_stack, self.decoder_5_conv, h, state_action_z)
         conv_rnn_state = conv_rnn_states[len(new_conv_rnn_states)]
         ### conv_rnn_h, conv_rnn_state 换为 hx,cx 6/2
-        hx, cx = self.decoder_5_rnn(conv_rnn_h, conv_rnn_state)
+        hx, cx = self.checkpoint_block(self.apply_conv_rnn, self.decoder_5_rnn, h, state_action_z, conv_rnn_state)
         conv_rnn_state = (hx, cx)
         conv_rnn_h = hx
         new_conv_rnn_states.append(conv_rnn_state)
         layers.append((h, conv_rnn_h))
         ### 第 6 层 5/29
         h = torch.cat([layers[-1][-1], layers[1][-1]], dim=1)
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
-        for layer in self.decoder_6_conv:
-            h = layer(h)
+        h = self.checkpoint_block(self.apply_conv_stack, self.decoder_6_conv, h, state_action_z)
         layers.append((h,))
         ### 第 7 层 5/29
         h = torch.cat([layers[-1][-1], layers[0][-1]], dim=1)
-        h = util.tile_concat([h, state_action_z[:, :, None, None]], axis=1)
-        for layer in self.decoder_7_conv:
-            h = layer(h)
+        h = self.checkpoint_block(self.apply_conv_stack, self.decoder_7_conv, h, state_action_z)
         layers.append((h,))
         assert len(new_conv_rnn_states) == len(conv_rnn_states)
         
@@ -504,61 +523,53 @@ class SAVPCell(nn.Module):
         cdna_kernels = cdna_kernels.reshape([-1] + self.cdna_kernel_shape)### self.batch_size改为-1 6/3
         #print(cdna_kernels.dtype)   ### torch.float32 6//2
         #print(identity_kernel(self.hparams.kernel_size)[None, :, :, None].dtype)  ### 6/2
-        cdna_kernels = cdna_kernels + identity_kernel(self.hparams.kernel_size)[None, :, :, None]
+        cdna_kernels = cdna_kernels + identity_kernel(self.hparams.kernel_size, cdna_kernels.device, cdna_kernels.dtype)[None, :, :, None]
         ### cdna_kernels.shape=(batch_size, 5, 5, last_frames * num_transformed_images) 5/30
         
         ############### scratch images ###############
         h_scratch = layers[-1][-1]
         for layer in self.scratch_h:
-            h_scrath = layer(h_scratch)
+            h_scratch = layer(h_scratch)
         
         scratch_image = h_scratch
         for layer in self.scratch_img:
             scratch_image = layer(scratch_image)
         
         ############# transformed images #############
-        transformed_images = []
-        #print('transformed_images input: last_images  ', len(last_images),last_images[0].shape)  ### 6/2
-        transformed_images.extend(apply_kernels(last_images, cdna_kernels, self.hparams.dilation_rate))
+        ### 所有的 transformed images 都放在一个 NKCHW 的 tensor 中，不再使用 list
+        transformed_images = [apply_kernels(last_images, cdna_kernels, self.hparams.dilation_rate)]
         if self.hparams.prev_image_background:
-            transformed_images.append(image)
+            transformed_images.append(image[:, None])
         if self.hparams.first_image_background and not self.hparams.context_images_background:
-            transformed_images.append(all_images[0])
+            transformed_images.append(all_images[0][:, None])
         if self.hparams.last_image_background and not self.hparams.context_images_background:
-            transformed_images.append(all_images[self.hparams.context_frames - 1])
+            transformed_images.append(all_images[self.hparams.context_frames - 1][:, None])
         if self.hparams.context_images_background:
-            transformed_images.extend(torch.split(all_images[:self.hparams.context_frames],1,dim=0))
+            transformed_images.append(all_images[:self.hparams.context_frames].transpose(0, 1))
         if self.hparams.generate_scratch_image:
-            transformed_images.append(scratch_image)
-        #print('transformed_images')
-        #for i,img in enumerate(transformed_images):
-        #    print(i, img.shape)
-        #print('-'*20)  ### 6/2
+            transformed_images.append(scratch_image[:, None])
+        transformed_images = torch.cat(transformed_images, dim=1)  ### NKCHW
         
         ################### mask ###################
         h_masks = layers[-1][-1]
         for layer in self.masks_h:
             h_masks = layer(h_masks)
         
-        #print('mask input: h_masks  ',h_masks.shape)   ### torch.Size([6, 32, 160, 320]) 6/2
-        #print('mask input: transformed_images  ',
-        #      len(transformed_images),transformed_images[0].shape) ### 7 torch.Size([1, 6, 320, 3, 160]) 6/2
-        masks = torch.cat([h_masks] + transformed_images, dim=1)  ### channel 维度级联 5/30
+        ### K 和 C 两个维度展开即为原来在 channel 维度上级联的结果 5/30
+        masks = torch.cat([h_masks, transformed_images.flatten(1, 2)], dim=1)
         for layer in self.masks:
-            masks = layer(masks)
-        
-        masks = torch.chunk(masks, len(transformed_images), dim=1)
-        #print('mask output: masks  ',len(masks),masks[0].shape)  ### 6/2
-        #print('-'*20)
+            ### softmax 固定在 fp32 下计算，不受 autocast 影响
+            masks = layer(masks.float() if isinstance(layer, nn.Softmax) else masks)  ### NKHW
+        assert transformed_images.shape[1] == masks.shape[1]
         
         ############# generate images #############
-        assert len(transformed_images) == len(masks)
-        gen_image = sum([trans_image * mask for trans_image, mask in zip(transformed_images, masks)])
+        gen_image = torch.sum(transformed_images * masks[:, :, None], dim=1)
         
         ################## output ##################
-        outputs = {'gen_images': gen_image,
-                   'transformed_images': torch.stack(transformed_images, dim=1),
-                   'masks': torch.stack(masks, dim=1)} ### dim 取值 -1？ 5/30 
+        outputs = {'gen_images': gen_image}
+        if self.hparams.keep_transformed_images:
+            outputs['transformed_images'] = transformed_images
+            outputs['masks'] = masks[:, :, None]
         new_states = {'time': time + 1,
                       'gen_image': gen_image,
                       'last_images': last_images,
@@ -569,6 +580,48 @@ class SAVPCell(nn.Module):
         return outputs, new_states
         
 
+class StateArena(object):
+    """
+    Allocates the zero initial states of a `SAVPCell` once per batch size,
+    device and dtype, and hands out the same tensors to every unroll.
+
+    The cell never modifies its states in place, so the cached tensors can
+    be shared by all the calls of `GeneratorGivenZ` (the posterior, prior and
+    samples passes, and all the training steps). Only the states of the
+    `max_size` most recently used keys are kept, so that the odd batch
+    sizes (the last batch of an eval pass, the batches of
+    `Rollout.concat`) don't stay allocated.
+    """
+    def __init__(self, image_shape, rnn_z_state_sizes, conv_rnn_state_sizes, max_size=2):
+        self.image_shape = list(image_shape)
+        self.rnn_z_state_sizes = list(rnn_z_state_sizes)
+        self.conv_rnn_state_sizes = [list(size) for size in conv_rnn_state_sizes]
+        self.max_size = max_size
+        self._states = OrderedDict()
+
+    def initial_states(self, batch_size, device, dtype):
+        key = (batch_size, device, dtype)
+        if key in self._states:
+            self._states.move_to_end(key)
+        else:
+            def zeros(size):
+                return torch.zeros([batch_size] + size, device=device, dtype=dtype)
+            self._states[key] = {
+                'gen_image': zeros(self.image_shape),
+                'rnn_z_state': (zeros(self.rnn_z_state_sizes), zeros(self.rnn_z_state_sizes)),
+                'conv_rnn_states': [(zeros(size), zeros(size)) for size in self.conv_rnn_state_sizes],
+            }
+            ### 最近最少使用的先释放 
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+        states = dict(self._states[key])
+        states['time'] = 0
+        return states
+
+    def clear(self):
+        self._states = OrderedDict()
+
+
 ### 编写于 5/23 6/1
 class GeneratorGivenZ(nn.Module):
     ### inputs 是一个 dict 5/23
@@ -584,68 +637,50 @@ class GeneratorGivenZ(nn.Module):
         savp_input_shape = {}
         savp_input_shape['images'] = list(input_shape['images'][-3:])
         savp_input_shape['zs'] = list(input_shape['zs'][-1:])
-        #print('GeneratorGivenZ: savp_input_shape  ',savp_input_shape)
         self.savpcell = SAVPCell(savp_input_shape, mode, hparams)
+        self.state_arena = StateArena(self.image_shape,
+                                      self.savpcell.rnn_z_state_sizes,
+                                      self.savpcell.conv_rnn_state_sizes)
         
         
     def forward(self, inputs):
         inputs = {name: util.maybe_pad_or_slice(input, self.hparams.sequence_length - 1)
               for name, input in inputs.items()}
-        batch_size = inputs['images'].shape[1]
-        #print('GeneratorGivenZ inputs[images]  ',inputs['images'].shape)
-        #print('GeneratorGivenZ batch_size',batch_size)
-        #print('-'*20)
-        #print('GeneratorGivenZ input : sequence_length  ',self.hparams.sequence_length)
-        #for k,v in inputs.items():
-        #    print(k,v.shape)
+        images = inputs['images']
+        batch_size = images.shape[1]
         ### initial state 6/1
-        states = {}
-        states['time'] = 0
-        states['gen_image'] = torch.zeros(self.image_shape).cuda(device)  ### 6/8
-        states['last_images'] = [inputs['images'][0]] * self.hparams.last_frames
-        #print(self.savpcell.rnn_z_state_sizes)
-        rnn_z_state_size = [batch_size] + self.savpcell.rnn_z_state_sizes
-        #print(self.savpcell.rnn_z_state_sizes)
-        conv_rnn_state_size = copy.deepcopy(self.savpcell.conv_rnn_state_sizes)  ### deepcopy()!!!! 6/3
-        #print('GeneratorGivenZ : self.savpcell.con_rnn_state_sizes[0]  ', self.savpcell.conv_rnn_state_sizes[0])
-        #print('GeneratorGivenZ : con_rnn_state_sizes[0]  ', conv_rnn_state_size[0])
-        for i in range(len(conv_rnn_state_size)):
-            conv_rnn_state_size[i] = [batch_size] + conv_rnn_state_size[i]
-        #print('GeneratorGivenZ : self.savpcell.con_rnn_state_sizes[0]  ',self.savpcell.conv_rnn_state_sizes[0])
-        states['rnn_z_state'] = (torch.zeros(rnn_z_state_size).cuda(device),torch.zeros(rnn_z_state_size).cuda(device))
-        states['conv_rnn_states'] = [(torch.zeros(conv_rnn_state_sz).cuda(device),
-                                      torch.zeros(conv_rnn_state_sz).cuda(device))
-                                    for conv_rnn_state_sz in conv_rnn_state_size]
-        
-        #print('GeneratorGivenZ : self.savpcell.con_rnn_state_sizes[0]  ',self.savpcell.conv_rnn_state_sizes[0])
+        states = self.state_arena.initial_states(batch_size, images.device, images.dtype)
+        states['last_images'] = [images[0]] * self.hparams.last_frames
+        
         ### 把 savpcell 扩展成 rnn 6/1
-        outputs = {}
-        for i in range(self.time_length):
-            input = {k: v[i] for k, v in inputs.items()}
-            output, new_states = self.savpcell(input, states, inputs['images'])
-            #print('GeneratorGivenZ rnn input:  ')   ### 6/2
-            #for k,v in input.items():
-            #    print(k, v.shape)
-            #print('GeneratorGivenZ rnn output:  ') ### 6/2
-            #for k,v in output.items():
-            #    print(k, v.shape)
-            if i==0:
-                for k in output.keys():
-                    outputs[k] = [output[k]]
+        ### 每一步的输出先放在 list 里，最后对每个 key 只做一次 stack
+        ### (逐步原地写入 (T, N, ...) 的 buffer 会在图中留下 T 个 CopySlices，每个在 backward 时都拷贝整个 buffer)
+        ### checkpoint_policy=steps 时每 checkpoint_every 步为一段，只保存段与段之间的 states，
+        ### 段内的激活在 backward 时重算；stack 不是 in-place 操作，放在 checkpoint 之外也没有问题
+        if self.hparams.checkpoint_policy == 'steps' and torch.is_grad_enabled():
+            segment_length = self.hparams.checkpoint_every
+        else:
+            segment_length = self.time_length
+        step_outputs = []
+        for start in range(0, self.time_length, segment_length):
+            stop = min(start + segment_length, self.time_length)
+            if segment_length < self.time_length:
+                segment_outputs, states = checkpoint(self.unroll, inputs, states, images, start, stop,
+                                                     use_reentrant=False)
             else:
-                for k in output.keys():
-                    outputs[k].append(output[k])
-            states = new_states
-            
-        for k,v in outputs.items():
-            outputs[k] = torch.stack(outputs[k], dim=0)
-            
-        print('GeneratorGivenZ outputs')
-        for k,v in outputs.items():
-            print(k, v.shape)
-        print('-'*20)
-        #print('GeneratorGivenZ : self.savpcell.con_rnn_state_sizes[0]  ',self.savpcell.conv_rnn_state_sizes)
+                segment_outputs, states = self.unroll(inputs, states, images, start, stop)
+            step_outputs.extend(segment_outputs)
+        outputs = {k: torch.stack([output[k] for output in step_outputs]) for k in step_outputs[0]}
         return outputs
+    
+    def unroll(self, inputs, states, images, start, stop):
+        ### 运行第 start 到 stop - 1 步，返回每一步的 output 和最后的 states
+        outputs = []
+        for i in range(start, stop):
+            input = {k: v[i] for k, v in inputs.items()}
+            output, states = self.savpcell(input, states, images)
+            outputs.append(output)
+        return outputs, states
 
 
 
@@ -682,13 +717,13 @@ class Generator(nn.Module):
             ### encoder 生成 posterior  5/23
             outputs_posterior = self.encoder(inputs['images'])
             #print(outputs_posterior)
-            eps = torch.randn(zs_shape).cuda(device)   ### cuda 6/8
+            eps = torch.randn(zs_shape, device=images.device, dtype=images.dtype)
             #print(type(outputs_posterior['zs_mu'])) ### 6/8
             #print(type(outputs_posterior['zs_log_sigma_sq']))
             #print(type(eps))
             zs_posterior = outputs_posterior['zs_mu'] + \
                     torch.sqrt(torch.exp(outputs_posterior['zs_log_sigma_sq'])) * eps
-            inputs_posterior = inputs
+            inputs_posterior = dict(inputs)
             inputs_posterior['zs'] = zs_posterior
             #print('Generator : inputs_posterior')
             #for k, v in inputs_posterior.items():
@@ -698,38 +733,21 @@ class Generator(nn.Module):
             ### 生成 prior 5/23
             if self.hparams.learn_prior:
                 outputs_prior = self.prior(inputs['images'])
-                eps = torch.randn(zs_shape).cuda(device)   ### cuda 6/8
+                eps = torch.randn(zs_shape, device=images.device, dtype=images.dtype)
                 zs_prior = outputs_prior['zs_mu'] + \
                     torch.sqrt(torch.exp(outputs_prior['zs_log_sigma_sq'])) * eps
             else:
                 outputs_prior = {}
                 zs_prior = torch.randn([self.hparams.sequence_length - self.hparams.context_frames] + \
-                                       zs_shape[1:]).cuda(device)  ### 6/8
+                                       zs_shape[1:], device=images.device, dtype=images.dtype)
                 zs_prior = torch.cat([zs_posterior[:self.hparams.context_frames - 1], zs_prior], dim=0)
-            inputs_prior = inputs
+            inputs_prior = dict(inputs)
             inputs_prior['zs'] = zs_prior
             #print('Generator : inputs_prior')
             #for k, v in inputs_prior.items():
             #    print(k, v.shape)
             #print('-'*20)
             
-            ### posterior 和 images 交给 generator 5/23
-            gen_outputs_posterior = self.generator(inputs_posterior)
-            #print('-'*20,' gen posterior complete ','-'*20)
-            gen_outputs = self.generator(inputs_prior)
-            #print('-'*20,' gen prior complete ','-'*20)
-            
-            # rename tensors to avoid name collisions
-            output_prior = collections.OrderedDict([(k + '_prior', v) for k, v in outputs_prior.items()])
-            outputs_posterior = collections.OrderedDict([(k + '_enc', v) for k, v in outputs_posterior.items()])
-            gen_outputs_posterior = collections.OrderedDict([(k + '_enc', v) for k, v in gen_outputs_posterior.items()])
-            
-            outputs = [output_prior, gen_outputs, outputs_posterior, gen_outputs_posterior]
-            total_num_outputs = sum([len(output) for output in outputs])
-            ### 整合 5/23
-            outputs = collections.OrderedDict(itertools.chain(*[output.items() for output in outputs]))
-            assert len(outputs) == total_num_outputs  # ensure no output is lost because of repeated keys
-
             ### 根据 prior 生成多个随机抽样 5/23
             ### num_samples 是采样的个数 5/23
             inputs_samples = {
@@ -739,17 +757,14 @@ class Generator(nn.Module):
                                 self.hparams.num_samples,
                                 batch_size,
                                 self.hparams.nz]
-            #print('Generator : inputs_samples')
-            #for k,v in inputs_samples.items():
-            #    print(k, v.shape)
-            #print('-'*20)
             if self.hparams.learn_prior:
-                eps = torch.randn(zs_samples_shape).cuda(device)
+                eps = torch.randn(zs_samples_shape, device=images.device, dtype=images.dtype)
                 zs_prior_samples = (outputs_prior['zs_mu'][:, None] +
                                 torch.sqrt(torch.exp(outputs_prior['zs_log_sigma_sq']))[:, None] * eps)
             else:
                 zs_prior_samples = torch.randn(
-                    [self.hparams.sequence_length - self.hparams.context_frames] + zs_samples_shape[1:]).cuda(device)
+                    [self.hparams.sequence_length - self.hparams.context_frames] + zs_samples_shape[1:],
+                    device=images.device, dtype=images.dtype)
                 zs_prior_samples = torch.cat(
                     [zs_posterior[:self.hparams.context_frames - 1][:, None].repeat(
                                   [1, self.hparams.num_samples, 1, 1]),
@@ -760,7 +775,34 @@ class Generator(nn.Module):
             ### 第1，2个维度压平 5/23
             inputs_prior_samples = {name: torch.flatten(input, start_dim=1, end_dim=2)
                                     for name, input in inputs_prior_samples.items()}
-            gen_outputs_samples = self.generator(inputs_prior_samples)
+            
+            if self.hparams.single_generator_pass:
+                ### posterior, prior 和 samples 沿 batch 维拼接，rnn 只展开一次，再按 batch 拆开
+                ### cell 里只有 InstanceNorm，每个样本独立计算，结果与分三次运行相同
+                all_inputs = [inputs_posterior, inputs_prior, inputs_prior_samples]
+                split_sizes = [batch_size, batch_size, batch_size * self.hparams.num_samples]
+                all_gen_outputs = self.generator({name: torch.cat([input[name] for input in all_inputs], dim=1)
+                                                  for name in inputs_posterior})
+                all_gen_outputs = {k: torch.split(v, split_sizes, dim=1) for k, v in all_gen_outputs.items()}
+                gen_outputs_posterior, gen_outputs, gen_outputs_samples = [
+                    {k: v[i] for k, v in all_gen_outputs.items()} for i in range(len(all_inputs))]
+            else:
+                ### posterior 和 images 交给 generator 5/23
+                gen_outputs_posterior = self.generator(inputs_posterior)
+                gen_outputs = self.generator(inputs_prior)
+                gen_outputs_samples = self.generator(inputs_prior_samples)
+            
+            # rename tensors to avoid name collisions
+            output_prior = collections.OrderedDict([(k + '_prior', v) for k, v in outputs_prior.items()])
+            outputs_posterior = collections.OrderedDict([(k + '_enc', v) for k, v in outputs_posterior.items()])
+            gen_outputs_posterior = collections.OrderedDict([(k + '_enc', v) for k, v in gen_outputs_posterior.items()])
+            
+            outputs = [output_prior, gen_outputs, outputs_posterior, gen_outputs_posterior]
+            total_num_outputs = sum([len(output) for output in outputs])
+            ### 整合 5/23
+            outputs = collections.OrderedDict(itertools.chain(*[output.items() for output in outputs]))
+            assert len(outputs) == total_num_outputs  # ensure no output is lost because of repeated keys
+
             gen_images_samples = gen_outputs_samples['gen_images']
             ### 再恢复出前两个维度 5/23
             #print('Generator samples')
@@ -769,12 +811,52 @@ class Generator(nn.Module):
             gen_images_samples_avg = torch.mean(gen_images_samples, dim=-1)
             outputs['gen_images_samples'] = gen_images_samples
             outputs['gen_images_samples_avg'] = gen_images_samples_avg
-        
+
         return outputs
+
+    def sample(self, images, num_samples=1):
+        """
+        Draws `num_samples` samples from the prior for every sequence of
+        `images`, in a single unroll of the generator over a batch of
+        num_samples * N sequences. Unlike `forward`, the posterior is only
+        used for the zs of the context frames (when the prior is not
+        learned), and there is no posterior or single prior pass.
+
+        Args:
+            images: a DNCHW tensor.
+            num_samples: the number of samples per sequence.
+
+        Returns:
+            The gen_images of the samples, of shape
+            (D - 1, num_samples, N, C, H, W).
+        """
+        batch_size = images.shape[1]
+        images_samples = images[:, None].expand(-1, num_samples, -1, -1, -1, -1).flatten(1, 2)
+        inputs_samples = {'images': images_samples}
+        if self.hparams.nz:
+            zs_shape = [self.zs_shape[0], num_samples, batch_size, self.hparams.nz]
+            if self.hparams.learn_prior:
+                outputs_prior = self.prior(images)
+                eps = torch.randn(zs_shape, device=images.device, dtype=images.dtype)
+                zs = (outputs_prior['zs_mu'][:, None] +
+                      torch.sqrt(torch.exp(outputs_prior['zs_log_sigma_sq']))[:, None] * eps)
+            else:
+                ### context 帧的 z 来自 posterior，每个样本各自采样
+                context_zs_length = self.hparams.context_frames - 1
+                outputs_posterior = self.encoder(images)
+                zs_mu = outputs_posterior['zs_mu'][:context_zs_length, None]
+                zs_sigma = torch.sqrt(torch.exp(outputs_posterior['zs_log_sigma_sq'][:context_zs_length, None]))
+                eps = torch.randn([context_zs_length] + zs_shape[1:], device=images.device, dtype=images.dtype)
+                zs_future = torch.randn([zs_shape[0] - context_zs_length] + zs_shape[1:],
+                                        device=images.device, dtype=images.dtype)
+                zs = torch.cat([zs_mu + zs_sigma * eps, zs_future.to(zs_mu.dtype)], dim=0)
+            inputs_samples['zs'] = zs.flatten(1, 2)
+        gen_images = self.generator(inputs_samples)['gen_images']
+        return gen_images.unflatten(1, (num_samples, batch_size))
         
         
 ### 5/30
-def identity_kernel(kernel_size):
+def identity_kernel(kernel_size, device=None, dtype=torch.float32):
     ### kernel 中心为1或0.25，其余为0，有什么用？ 5/19
     kh, kw = kernel_size
     kernel = np.zeros(kernel_size)
@@ -789,32 +871,31 @@ def identity_kernel(kernel_size):
 
     kernel[center_slice(kh), center_slice(kw)] = 1.0
     kernel /= np.sum(kernel)
-    return torch.FloatTensor(kernel).cuda(device)
+    return torch.tensor(kernel, device=device, dtype=dtype)
         
 def apply_kernels(image, kernels, dilation_rate=(1, 1)):
     """
     Args:
         image: A 4-D tensor of shape
-            `[batch, in_channels, in_height, in_width]`.
+            `[batch, in_channels, in_height, in_width]`, or a list of them.
         kernels: A 4-D tensor of shape
-            `[batch, kernel_size[0], kernel_size[1], num_transformed_images]` or
+            `[batch, kernel_size[0], kernel_size[1], num_transformed_images]`.
+            If `image` is a list, the last dimension is split evenly among
+            its images.
 
     Returns:
-        A list of `num_transformed_images` 4-D tensors, each of shape
-            `[batch, in_height, in_width, in_channels]`.
+        A 5-D tensor of shape
+            `[batch, num_transformed_images, in_channels, in_height, in_width]`.
     """
     if isinstance(image, list):
         image_list = image
         kernels_list = torch.chunk(kernels, len(image_list), dim=-1)
-        outputs = []
-        for image, kernels in zip(image_list, kernels_list):
-            outputs.extend(apply_kernels(image, kernels))
+        outputs = torch.cat([apply_cdna_kernels(image, kernels, dilation_rate=dilation_rate)
+                             for image, kernels in zip(image_list, kernels_list)], dim=1)
     else:
         outputs = apply_cdna_kernels(image, kernels, dilation_rate=dilation_rate)
-    #print('apply_kernels: output  ', len(outputs),outputs[0].shape)  ### 6/2
     return outputs
 
-### 待测试。。。5/30
 def apply_cdna_kernels(images, kernels, dilation_rate=(1, 1)):
     """
     Args:
@@ -824,41 +905,33 @@ def apply_cdna_kernels(images, kernels, dilation_rate=(1, 1)):
             `[batch, kernel_size[0], kernel_size[1], num_transformed_images]`.
 
     Returns:
-        A list of `num_transformed_images` 4-D tensors, each of shape
-            `[batch, in_channels, in_height, in_width]`.
+        A 5-D tensor of shape
+            `[batch, num_transformed_images, in_channels, in_height, in_width]`.
     """
-    #print('apply_cnda_kernels input: images  ',images.shape)  ### torch.Size([6, 3, 160, 320]) 6/2
-    #print('apply_cnda_kernels input: kernels  ',kernels.shape) ### 6/2
     batch_size, color_channels, height, width = images.shape
     batch_size, kernel_height, kernel_width, num_transformed_images = kernels.shape
-    images = images.permute([1, 0, 2, 3])
-    kernels = kernels.permute([3, 0, 1, 2])
-    images = torch.chunk(images, batch_size, dim=1)
-    kernels = torch.chunk(kernels, batch_size, dim=1)
-    outputs = []
-    for img, k in zip(images, kernels):
-        ### 将 color_channel 看作 batch_size，因为对不同的通道，transform是相同的 5/30
-        ### 对每个 sample 应用不同的 kernel 5/30
-        ### img = C1HW
-        ### K = C'1hw
-        ### output = CC'HW
-        output = F.conv2d(input=img, weight=k, padding=2) ### kernel 为 5*5 5/30
-        outputs.append(output)
-    ### outputs = NCC'HW 5/30
-    outputs = torch.cat(outputs, dim=0)
-    #print('apply_cnda_kernels: output_cat  ', outputs.shape)   ### 6/2
+    dilation_rate = tuple(dilation_rate)
+    ### 将 batch 和 color_channel 合并为 groups，每个 group 是一个 sample 的一个通道 
+    ### 一次 grouped conv 即可对每个 sample 应用它自己的 num_transformed_images 个 kernel
+    images = images.reshape([1, batch_size * color_channels, height, width])
+    kernels = kernels.permute([0, 3, 1, 2])[:, None]  ### N1K'hw
+    kernels = kernels.expand([batch_size, color_channels, num_transformed_images, kernel_height, kernel_width])
+    kernels = kernels.reshape([batch_size * color_channels * num_transformed_images, 1, kernel_height, kernel_width])
+    # 'SAME' padding, the extra row/column (if any) goes to the bottom/right as in tf
+    pad_height = dilation_rate[0] * (kernel_height - 1)
+    pad_width = dilation_rate[1] * (kernel_width - 1)
+    if pad_height % 2 or pad_width % 2:
+        images = F.pad(images, [pad_width // 2, pad_width - pad_width // 2,
+                                pad_height // 2, pad_height - pad_height // 2])
+        padding = 0
+    else:
+        padding = (pad_height // 2, pad_width // 2)
+    outputs = F.conv2d(images, kernels, padding=padding, dilation=dilation_rate,
+                       groups=batch_size * color_channels)
+    ### outputs = 1(NCK')HW to NK'CHW
     outputs = outputs.reshape([batch_size, color_channels, num_transformed_images, height, width])
-    outputs = outputs.permute([2, 0, 1, 3, 4])  ### C'NCHW 5/30
-    #print('apply_cnda_kernels: output_rehsape  ', outputs.shape)  ### 6/2
-    outputs = list(torch.split(outputs, 1, dim=0))
-    for i in range(len(outputs)):
-        #print(outputs[i].shape)  ### 6/8
-        outputs[i] = torch.squeeze(outputs[i],dim=0)
-    #print('apply_cnda_kernels: output_split  ',len(outputs),outputs[0].shape)  ### 6/2
-    return outputs
-    
+    return outputs.transpose(1, 2)
 
-    
 
 ### 融合BaseVideoPredModel 和 VideoPredModel 5/15
 class SAVPModel(nn.Module):
@@ -866,7 +939,7 @@ class SAVPModel(nn.Module):
     def __init__(self, input_shape, mode='train', hparams_dict=None, hparams=None,
                  num_gpus=None, eval_num_samples=100,
                  eval_num_samples_for_diversity=10, eval_parallel_iterations=1,
-                 aggregate_nccl=False,
+                 aggregate_nccl=False, device=None,
                  **kwargs):
         super(SAVPModel, self).__init__()
         self.input_shape = [input_shape[1],input_shape[0],input_shape[4]] + list(input_shape[2:4])  ### 6/8
@@ -883,9 +956,12 @@ class SAVPModel(nn.Module):
         #elif num_gpus > max_num_gpus:
         #    raise ValueError('num_gpus=%d is greater than the number of visible devices %d' % (num_gpus, max_num_gpus))
         #self.num_gpus = num_gpus
-        #self.eval_num_samples = eval_num_samples
-        #self.eval_num_samples_for_diversity = eval_num_samples_for_diversity
-        #self.eval_parallel_iterations = eval_parallel_iterations
+        if eval_num_samples < 1 or eval_parallel_iterations < 1:
+            raise ValueError('eval_num_samples and eval_parallel_iterations must be at least 1')
+        self.eval_num_samples = eval_num_samples
+        self.eval_num_samples_for_diversity = eval_num_samples_for_diversity
+        ### 评估时一次并行生成的样本数 
+        self.eval_parallel_iterations = eval_parallel_iterations
         self.hparams = self.parse_hparams(hparams_dict, hparams)
         if self.hparams.context_frames == -1:
             raise ValueError('Invalid context_frames %r. It might have to be '
@@ -893,9 +969,19 @@ class SAVPModel(nn.Module):
         if self.hparams.sequence_length == -1:
             raise ValueError('Invalid sequence_length %r. It might have to be '
                              'specified.' % self.hparams.sequence_length)
-        
-        # should be overriden by descendant class if the model is stochastic
-        self.deterministic = True
+        if self.hparams.checkpoint_policy not in ('none', 'steps', 'blocks'):
+            raise ValueError('Unknown checkpoint_policy %s' % self.hparams.checkpoint_policy)
+        if self.hparams.checkpoint_every < 1:
+            raise ValueError('Invalid checkpoint_every %r. It must be at least 1.' % self.hparams.checkpoint_every)
+        
+        if self.hparams.kl_anneal not in ('none', 'sigmoid', 'linear'):
+            raise ValueError('Unknown kl_anneal %s' % self.hparams.kl_anneal)
+        if self.hparams.kl_anneal == 'sigmoid' and self.hparams.kl_anneal_k == -1.0:
+            raise ValueError('Invalid kl_anneal_k %d when kl_anneal is sigmoid.' % self.hparams.kl_anneal_k)
+        ### 随 step 退火，由 train_step 更新 
+        self.kl_weight = self.get_kl_weight(0)
+        
+        self.deterministic = not self.hparams.nz
 
         # member variables that should be set by `self.build_graph`
         self.inputs = None
@@ -915,26 +1001,202 @@ class SAVPModel(nn.Module):
         #    self.discriminator = None
         self.discriminator = Discriminator(image_shape=self.input_shape[-3:], mode=self.mode, hparams=self.hparams)
         #self.aggregate_nccl = aggregate_nccl
+        ### distribute() 之后的 DDP wrapper。用普通的 dict 保存，不注册为子模块，state_dict 不变
+        self.ddp_modules = {}
+        ### discriminator 随机抽取帧和子序列用的 torch.Generator，由 seed() 设置，None 时使用全局的 RNG
+        self.discrim_generator = None
+        if device is not None:
+            self.to(device)
+        
+    @property
+    def device(self):
+        ### 模型所在的 device 和 dtype 由参数决定，.to() 之后自动跟着变
+        return next(self.parameters()).device
+    
+    @property
+    def dtype(self):
+        return next(self.parameters()).dtype
+    
+    def seed(self, seed):
+        """
+        Makes the frames and clips sampled by the discriminator reproducible,
+        with a `torch.Generator` on the device of the model seeded with `seed`
+        instead of the global RNG. Its state is `discrim_generator.get_state()`.
+        It has to be called after the model is moved to its device.
+        """
+        self.discrim_generator = torch.Generator(device=self.device)
+        self.discrim_generator.manual_seed(seed)
         
         
     ### inputs.shape=()? 5/15
     ### inputs = {'images':NDHWC, }
     ### outputs = {'':DNCHW}
+    def autocast(self):
+        """
+        Returns the autocast context of `hparams.precision` for the device of
+        the model. It is a no-op for fp32.
+        """
+        if self.hparams.precision not in ('fp32', 'fp16', 'bf16'):
+            raise ValueError('Unknown precision %s' % self.hparams.precision)
+        dtype = torch.bfloat16 if self.hparams.precision == 'bf16' else torch.float16
+        return torch.autocast(self.device.type, dtype=dtype, enabled=self.hparams.precision != 'fp32')
+    
+    def grad_scaler(self):
+        """
+        Returns a `GradScaler`, enabled only for fp16. The same scaler is
+        meant to be shared by the generator and discriminator optimizers:
+        `scale()` each loss, `step()` each optimizer, then a single
+        `update()` per training step.
+        """
+        return torch.amp.GradScaler(self.device.type, enabled=self.hparams.precision == 'fp16')
+    
+    def learning_rate(self, step):
+        """
+        The learning rate at `step`, following the TF model: piecewise
+        constant with a 10x decay at each of `lr_boundaries` if any of them
+        is nonzero, otherwise a linear decay from `lr` to `end_lr` over
+        `decay_steps`.
+        """
+        hparams = self.hparams
+        if any(hparams.lr_boundaries):
+            num_decays = sum(step > boundary for boundary in hparams.lr_boundaries)
+            return hparams.lr * 0.1 ** num_decays
+        if any(hparams.decay_steps):
+            start_step, end_step = hparams.decay_steps
+            if start_step == end_step:
+                schedule = 0.0 if step < start_step else 1.0
+            else:
+                schedule = float(min(max(step, start_step), end_step) - start_step) / (end_step - start_step)
+            return hparams.lr + (hparams.end_lr - hparams.lr) * schedule
+        return hparams.lr
+    
+    def get_kl_weight(self, step):
+        """
+        The weight of the KL loss at `step`, annealed according to
+        `kl_anneal`. None if `kl_weight` is zero.
+        """
+        hparams = self.hparams
+        if not hparams.kl_weight:
+            return None
+        if hparams.kl_anneal == 'none':
+            return hparams.kl_weight
+        if hparams.kl_anneal == 'sigmoid':
+            k = hparams.kl_anneal_k
+            return hparams.kl_weight / (1 + k * np.exp(-step / k))
+        start_step, end_step = hparams.kl_anneal_steps
+        step = min(max(step, start_step), end_step)
+        return hparams.kl_weight * float(step - start_step) / (end_step - start_step)
+    
+    def make_optimizers(self):
+        """
+        Returns the Adam optimizers of the generator and the discriminator.
+        On CUDA the update of all the parameters of an optimizer runs as one
+        fused kernel, elsewhere as a few multi-tensor (foreach) ops.
+        """
+        kwargs = dict(lr=self.hparams.lr, betas=(self.hparams.beta1, self.hparams.beta2))
+        if self.device.type == 'cuda':
+            kwargs['fused'] = True
+        else:
+            kwargs['foreach'] = True
+        g_optimizer = optim.Adam(self.generator.parameters(), **kwargs)
+        d_optimizer = optim.Adam(self.discriminator.parameters(), **kwargs)
+        return g_optimizer, d_optimizer
+    
+    def distribute(self, device_ids=None, **ddp_kwargs):
+        """
+        Wraps the generator and the discriminator in two separate
+        `DistributedDataParallel`, so that the gradients of each of the two
+        updates of `train_step` are all-reduced by their own reducer. The
+        process group must already be initialized.
+
+        The spectral norm vectors of the discriminator are buffers, so they
+        are broadcast from rank 0 at every forward (`broadcast_buffers`).
+        The discriminator is not wrapped if all its loss weights are zero.
+        """
+        from torch.nn.parallel import DistributedDataParallel
+        self.ddp_modules = {'generator': DistributedDataParallel(self.generator, device_ids=device_ids, **ddp_kwargs)}
+        if any(p.requires_grad for p in self.discriminator.parameters()):
+            self.ddp_modules['discriminator'] = DistributedDataParallel(self.discriminator, device_ids=device_ids,
+                                                                        **ddp_kwargs)
+    
+    def train_step(self, inputs, g_optimizer, d_optimizer, scaler, step):
+        """
+        Runs one training step at global step `step`: a discriminator update
+        followed by a generator update, like the `train_op` of the TF model.
+
+        The discriminator loss only backpropagates into the discriminator
+        and the generator loss only into the generator, and an update is
+        skipped entirely if all its loss weights are zero. Unless
+        `joint_gan_optimization`, the discriminator outputs used by the
+        generator loss are recomputed with the updated discriminator.
+
+        Args:
+            inputs: a dict with the uint8 NDHWC `images`. It is updated
+                in-place with the preprocessed DNCHW images.
+            g_optimizer, d_optimizer: the optimizers from `make_optimizers`.
+            scaler: the `GradScaler` from `grad_scaler`.
+            step: the global step, for the learning rate and the KL weight.
+
+        Returns:
+            A tuple of the outputs, the discriminator losses and the
+            generator losses, as dicts of (loss, weight) tuples.
+        """
+        lr = self.learning_rate(step)
+        for optimizer in (g_optimizer, d_optimizer):
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+        self.kl_weight = self.get_kl_weight(step)
+        joint_gan_optimization = self.hparams.joint_gan_optimization
+        
+        outputs = self(inputs)
+        d_losses = self.discriminator_loss(inputs, outputs)
+        if d_losses:
+            d_loss = sum(loss * weight for loss, weight in d_losses.values())
+            d_optimizer.zero_grad()
+            scaler.scale(d_loss).backward(inputs=[p for p in self.discriminator.parameters() if p.requires_grad],
+                                          retain_graph=joint_gan_optimization)
+            if not joint_gan_optimization:
+                scaler.step(d_optimizer)
+                ### 对应 TF 版本的 replace_read_ops：G 的 loss 用更新后的 D 重新计算
+                ### 这里不经过 DDP wrapper，这次 forward 之后不会有 D 的梯度，reducer 不能等待它们
+                with self.autocast():
+                    outputs.update(self.discriminator(inputs, outputs, generator=self.discrim_generator))
+        g_losses = self.generator_loss(inputs, outputs)
+        if g_losses:
+            g_loss = sum(loss * weight for loss, weight in g_losses.values())
+            g_optimizer.zero_grad()
+            scaler.scale(g_loss).backward(inputs=[p for p in self.generator.parameters() if p.requires_grad])
+            scaler.step(g_optimizer)
+        if d_losses and joint_gan_optimization:
+            scaler.step(d_optimizer)
+        scaler.update()
+        return outputs, d_losses, g_losses
+    
     def forward(self, inputs):
-        inputs['images'] = inputs['images'].permute(1,0,4,2,3)   ### NDHWC to DNCHW 6/8
-        inputs['images'] = inputs['images'].to(device)
+        ### NDHWC(uint8) to DNCHW(float, [0, 1]) 6/8
+        inputs['images'] = util.preprocess_images(inputs['images'], self.device, self.dtype)
         #images = inputs['images'].to(device)
         outputs = {}
-        output = self.generator(inputs['images'])
-        outputs.update(output)
-        #if self.discrim:   ### 暂时忽略 6/8
-        #    output = self.discriminator(inputs, output)
-        #    outputs.update(output)
-        output = self.discriminator(inputs, output)
-        outputs.update(output)
+        generator = self.ddp_modules.get('generator', self.generator)
+        discriminator = self.ddp_modules.get('discriminator', self.discriminator)
+        with self.autocast():
+            output = generator(inputs['images'])
+            outputs.update(output)
+            #if self.discrim:   ### 暂时忽略 6/8
+            #    output = self.discriminator(inputs, output)
+            #    outputs.update(output)
+            output = discriminator(inputs, output, generator=self.discrim_generator)
+            outputs.update(output)
         outputs = OrderedDict(outputs)
         return outputs
         
+    def generate(self, inputs):
+        ### 只跑 generator (不经过 DDP wrapper，也不跑 discriminator)，用于 validation
+        inputs['images'] = util.preprocess_images(inputs['images'], self.device, self.dtype)
+        with self.autocast():
+            outputs = self.generator(inputs['images'])
+        return OrderedDict(outputs)
+
     def loss(self, inputs, outputs):
         ### inputs['images']=DNCHW 6/8
         d_losses = self.discriminator_loss(inputs, outputs)
@@ -1000,6 +1262,12 @@ class SAVPModel(nn.Module):
             context_images_background=False,
             generate_scratch_image=True,
             dependent_mask=True,
+            keep_transformed_images=False,   ### 是否输出 transformed_images 和 masks，仅用于可视化
+            single_generator_pass=True,   ### posterior, prior 和 samples 拼成一个 batch，generator 只运行一次
+            fold_z_into_conv=False,   ### z 不在空间上复制，折叠进后面的 conv，结果与 tile_concat 相同
+            precision='fp32',   ### fp32, fp16 或 bf16，后两者在 autocast 下运行 forward
+            checkpoint_policy='none',   ### none, steps 或 blocks，用重算换显存，见 GeneratorGivenZ 和 SAVPCell
+            checkpoint_every=1,   ### checkpoint_policy=steps 时每段的步数
             #schedule_sampling='inverse_sigmoid',
             #schedule_sampling_k=900.0,
             #schedule_sampling_steps=(0, 100000),
@@ -1173,80 +1441,162 @@ class SAVPModel(nn.Module):
                     gen_losses["gen%s_vae_gan_feature_cdist_loss" % infix] = \
                         (gen_vae_gan_feature_cdist_loss, hparams.vae_gan_feature_cdist_weight)
         
-        if hparams.kl_weight:
+        if self.kl_weight:   ### 退火后权重为 0 时不计算 
             gen_kl_loss = vp.losses.kl_loss(outputs['zs_mu_enc'], outputs['zs_log_sigma_sq_enc'],
                                 outputs.get('zs_mu_prior'), outputs.get('zs_log_sigma_sq_prior'))
             gen_losses["gen_kl_loss"] = (gen_kl_loss, self.kl_weight)  # possibly annealed kl_weight
         
         return gen_losses
         
-    def metrics_fn(self, inputs, outputs):
-        ### inputs['images']=DNCHW 6/8
-        metrics = OrderedDict()
+    def frame_metrics_fn(self, inputs, outputs, lpips_network=None):
+        ### inputs['images']=DNCHW，返回每帧每个样本的 metric，形状为 (future_length, N)
+        ### 给出 lpips_network 时也计算 lpips，ground truth 的特征按 inputs['sample_id'] 缓存
         sequence_length = inputs['images'].shape[0]
         context_frames = self.hparams.context_frames
         future_length = sequence_length - context_frames
         # target_images and pred_images include only the future frames
         target_images = inputs['images'][-future_length:]
         pred_images = outputs['gen_images'][-future_length:]
-        metric_fns = [
-            ('psnr', vp.metrics.psnr),    ### 待完成。。。 6/8
-            ('mse', vp.metrics.mse),
-            ('ssim', vp.metrics.ssim),
-            ('lpips', vp.metrics.lpips),
-        ]
-        for metric_name, metric_fn in metric_fns:
-            metrics[metric_name] = torch.mean(metric_fn(target_images, pred_images))
+        return vp.metrics.compute_metrics(target_images, pred_images, lpips_network=lpips_network,
+                                          sample_ids=inputs.get('sample_id'))
+
+    def metrics_fn(self, inputs, outputs):
+        ### inputs['images']=DNCHW 6/8
+        metrics = OrderedDict()
+        for metric_name, metric in self.frame_metrics_fn(inputs, outputs).items():
+            metrics[metric_name] = torch.mean(metric)
         return metrics
         
-    def eval_outputs_and_metrics_fn(self, inputs, outputs, num_samples=None,
-                                    num_samples_for_diversity=None, parallel_iterations=None):
+    def eval_outputs_and_metrics_fn(self, inputs, outputs=None, num_samples=None,
+                                    num_samples_for_diversity=None, parallel_iterations=None,
+                                    lpips_network=None):
+        """
+        Best-of-N evaluation of the samples of the prior, as in the SAVP
+        paper.
+
+        `num_samples` samples are drawn for every sequence,
+        `parallel_iterations` of them at a time in a single unroll of the
+        generator. Only running statistics are kept: for every metric, the
+        min/sum/max over the samples for each frame and sequence, and the
+        gen_images of the samples with the min and max metric (averaged over
+        time). The memory does not grow with `num_samples`.
+
+        Args:
+            inputs: a dict with the preprocessed (DNCHW) `images`, and
+                optionally the `sample_id` of the sequences, which lets
+                lpips cache the features of the target frames.
+            outputs: the outputs of the model, only used (if given) by
+                deterministic models.
+            num_samples: defaults to `self.eval_num_samples`.
+            num_samples_for_diversity: defaults to
+                `self.eval_num_samples_for_diversity`.
+            parallel_iterations: the number of samples drawn at once.
+                Defaults to `self.eval_parallel_iterations`.
+            lpips_network: the `LPIPS` network, required for lpips and the
+                diversity score.
+
+        Returns:
+            A tuple of the `eval_outputs` and the `eval_metrics` dicts.
+            eval_outputs includes all the frames: `eval_images` and the
+            `eval_gen_images_<metric>/{min,avg,max}`. eval_metrics includes
+            only the future frames: `eval_<metric>/{min,avg,max}` of shape
+            (future_length, N) and, with `lpips_network`, `eval_diversity`,
+            the average lpips distance between consecutive samples among the
+            first num_samples_for_diversity + 1 ones.
+        """
         ### inputs['images']=DNCHW 6/8
         num_samples = num_samples or self.eval_num_samples
         num_samples_for_diversity = num_samples_for_diversity or self.eval_num_samples_for_diversity
         parallel_iterations = parallel_iterations or self.eval_parallel_iterations
         
         sequence_length, batch_size = list(inputs['images'].shape[:2])
-        if batch_size is None:
-            batch_size = tf.shape(inputs['images'])[1]
-        if sequence_length is None:
-            sequence_length = tf.shape(inputs['images'])[0]
         context_frames = self.hparams.context_frames
         future_length = sequence_length - context_frames
+        sample_ids = inputs.get('sample_id')
+        if sample_ids is not None:
+            sample_ids = [int(sample_id) for sample_id in sample_ids]
         # the outputs include all the frames, whereas the metrics include only the future frames
         eval_outputs = OrderedDict()
         eval_metrics = OrderedDict()
-        metric_fns = [
-            ('psnr', vp.metrics.psnr),
-            ('mse', vp.metrics.mse),
-            ('ssim', vp.metrics.ssim),
-            ('lpips', vp.metrics.lpips),
-        ]
         # images and gen_images include all the frames
         images = inputs['images']
-        gen_images = outputs['gen_images']
         # target_images and pred_images include only the future frames
         target_images = inputs['images'][-future_length:]
-        pred_images = outputs['gen_images'][-future_length:]
         # ground truth is the same for deterministic and stochastic models
         eval_outputs['eval_images'] = images
         if self.deterministic:
-            for metric_name, metric_fn in metric_fns:
-                metric = metric_fn(target_images, pred_images)
+            if outputs is None:
+                with torch.no_grad(), self.autocast():
+                    outputs = self.generator(images)
+            gen_images = outputs['gen_images']
+            metrics = vp.metrics.compute_metrics(target_images, gen_images[-future_length:],
+                                                 lpips_network=lpips_network, sample_ids=sample_ids)
+            for metric_name, metric in metrics.items():
                 eval_metrics['eval_%s/min' % metric_name] = metric
                 eval_metrics['eval_%s/avg' % metric_name] = metric
                 eval_metrics['eval_%s/max' % metric_name] = metric
             eval_outputs['eval_gen_images'] = gen_images
-        else:
-            def transpose_batch_time(tensor):
-                return tensor.transpose(0,1)
-                
-            def where_axis1(cond, x, y):
-                return transpose_batch_time(torch.where(cond, transpose_batch_time(x), transpose_batch_time(y)))
-            
-            def accum_gen_images_and_metrics_fn(a, unused):
-                ### 待完成。。。 6/8
-                
-                
-                
-                
\ No newline at end of file
+            return eval_outputs, eval_metrics
+
+        def sort_criterion(x):
+            return torch.mean(x, dim=0)
+
+        accum = {}
+        batch_index = torch.arange(batch_size, device=images.device)
+        diversity = 0
+        num_diversity_pairs = 0
+        pred_images_last = None
+        with torch.no_grad():
+            for sample_ind in range(0, num_samples, parallel_iterations):
+                ### 每次并行生成 chunk_size 个样本，(D - 1, chunk_size, N, C, H, W)
+                chunk_size = min(parallel_iterations, num_samples - sample_ind)
+                with self.autocast():
+                    gen_images_samples = self.generator.sample(images, chunk_size).float()
+                pred_images_samples = gen_images_samples[-future_length:]
+                metrics = vp.metrics.compute_metrics(
+                    target_images[:, None].expand_as(pred_images_samples).flatten(1, 2),
+                    pred_images_samples.flatten(1, 2), lpips_network=lpips_network,
+                    sample_ids=None if sample_ids is None else sample_ids * chunk_size)
+                for name, metric in metrics.items():
+                    metric = metric.unflatten(1, (chunk_size, batch_size))   # time, chunk_size, batch_size
+                    for kind, select_fn, better_fn in (('min', torch.argmin, torch.lt), ('max', torch.argmax, torch.gt)):
+                        ### 先在这个 chunk 内选出最好/最差的样本，再与之前的结果比较
+                        ind = select_fn(sort_criterion(metric), dim=0)
+                        chunk_metric = metric.gather(1, ind.expand(future_length, 1, batch_size)).squeeze(1)
+                        chunk_gen_images = gen_images_samples[:, ind, batch_index]
+                        metric_key = 'eval_%s/%s' % (name, kind)
+                        images_key = 'eval_gen_images_%s/%s' % (name, kind)
+                        if metric_key in accum:
+                            cond = better_fn(sort_criterion(chunk_metric), sort_criterion(accum[metric_key]))
+                            chunk_metric = torch.where(cond, chunk_metric, accum[metric_key])
+                            chunk_gen_images = torch.where(cond[:, None, None, None], chunk_gen_images, accum[images_key])
+                        accum[metric_key] = chunk_metric
+                        accum[images_key] = chunk_gen_images
+                    metric_sum = metric.sum(dim=1)
+                    accum['eval_%s/sum' % name] = metric_sum + accum.get('eval_%s/sum' % name, 0)
+                ### 所有 metric 的平均图像相同，只累加一次
+                accum['eval_gen_images/sum'] = gen_images_samples.sum(dim=1) + accum.get('eval_gen_images/sum', 0)
+
+                if lpips_network is not None and num_diversity_pairs < num_samples_for_diversity:
+                    ### 相邻两个样本之间的 lpips 距离，包括上一个 chunk 的最后一个样本
+                    pred_images_pairs = pred_images_samples
+                    if pred_images_last is not None:
+                        pred_images_pairs = torch.cat([pred_images_last[:, None], pred_images_samples], dim=1)
+                    num_pairs = min(pred_images_pairs.shape[1] - 1, num_samples_for_diversity - num_diversity_pairs)
+                    if num_pairs > 0:
+                        distance = lpips_network(pred_images_pairs[:, :num_pairs].flatten(1, 2),
+                                                 pred_images_pairs[:, 1:num_pairs + 1].flatten(1, 2))
+                        diversity = distance.unflatten(1, (num_pairs, batch_size)).sum(dim=1) + diversity
+                        num_diversity_pairs += num_pairs
+                    pred_images_last = pred_images_samples[:, -1]
+
+        for name in metrics:
+            eval_outputs['eval_gen_images_%s/min' % name] = accum['eval_gen_images_%s/min' % name]
+            eval_outputs['eval_gen_images_%s/avg' % name] = accum['eval_gen_images/sum'] / float(num_samples)
+            eval_outputs['eval_gen_images_%s/max' % name] = accum['eval_gen_images_%s/max' % name]
+            eval_metrics['eval_%s/min' % name] = accum['eval_%s/min' % name]
+            eval_metrics['eval_%s/avg' % name] = accum['eval_%s/sum' % name] / float(num_samples)
+            eval_metrics['eval_%s/max' % name] = accum['eval_%s/max' % name]
+        if num_diversity_pairs:
+            eval_metrics['eval_diversity'] = diversity / float(num_diversity_pairs)
+        return eval_outputs, eval_metrics
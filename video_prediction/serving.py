@@ -0,0 +1,426 @@
+### 多路视频流的在线推理服务
+### 每一路流保存自己的 Rollout 状态，不同流的请求动态地拼成 batch，一起运行 SAVPCell
+
+import collections
+import io
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import torch
+
+from video_prediction.models.rollout import Rollout
+from video_prediction.utils import util
+
+
+class Request(object):
+    def __init__(self, stream_id, frame=None, k=0):
+        self.stream_id = stream_id
+        self.frame = frame
+        self.k = k
+        self.arrival_time = time.time()
+        self.future = Future()
+
+
+class ServerMetrics(object):
+    """
+    Counters of the batches and the latencies of the requests (from their
+    arrival to their result) over a sliding window.
+    """
+    def __init__(self, max_batch_size, window_size=10000):
+        self.max_batch_size = max_batch_size
+        self.latencies = collections.deque(maxlen=window_size)
+        self.batch_sizes = collections.deque(maxlen=window_size)
+        self.queue_depths = collections.deque(maxlen=window_size)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()
+
+    def record_batch(self, batch_size, queue_depth):
+        with self.lock:
+            self.num_batches += 1
+            self.batch_sizes.append(batch_size)
+            self.queue_depths.append(queue_depth)
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(latency)
+
+    def snapshot(self, queue_depth=None):
+        """
+        Returns a json-serializable dict of the metrics. The batch fill is
+        the average fraction of `max_batch_size` used by the batches, and
+        the queue depth is the number of requests still waiting when a
+        batch is formed.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes, dtype=np.float64)
+            queue_depths = np.array(self.queue_depths, dtype=np.float64)
+            metrics = collections.OrderedDict([
+                ('num_requests', self.num_requests),
+                ('num_batches', self.num_batches),
+                ('queue_depth', queue_depth),
+                ('mean_queue_depth', float(queue_depths.mean()) if len(queue_depths) else 0.0),
+                ('max_queue_depth', int(queue_depths.max()) if len(queue_depths) else 0),
+                ('mean_batch_size', float(batch_sizes.mean()) if len(batch_sizes) else 0.0),
+                ('batch_fill', float(batch_sizes.mean() / self.max_batch_size) if len(batch_sizes) else 0.0),
+                ('latency_p50_ms', float(np.percentile(latencies, 50)) if len(latencies) else 0.0),
+                ('latency_p99_ms', float(np.percentile(latencies, 99)) if len(latencies) else 0.0),
+            ])
+        return metrics
+
+
+class InferenceServer(object):
+    """
+    Serves the predictions of a `SAVPModel` for many streams of frames.
+
+    Every stream has its own `Rollout` of batch size 1. The requests of all
+    the streams go into one queue. A single worker thread takes the oldest
+    request and waits for more until it has `max_batch_size` of them or the
+    oldest one has waited `max_latency` seconds. The started streams of the
+    batch then run their cell steps as one batch, and the results are
+    scattered back to the requests. A stream has at most one request in a
+    batch, and its requests are served in order.
+
+        server = InferenceServer(model, max_batch_size=16, max_latency=0.005)
+        server.start()
+        gen_images = server.submit('camera0', frame, k=5).result()
+        server.stop()
+    """
+    def __init__(self, model, max_batch_size=16, max_latency=0.005):
+        """
+        Args:
+            model: a `SAVPModel`.
+            max_batch_size: the maximum number of requests in a batch.
+            max_latency: the maximum time in seconds a request waits for the
+                batch to fill up.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.image_shape = list(model.input_shape[-2:]) + [model.input_shape[-3]]   # HWC
+        self.metrics = ServerMetrics(max_batch_size)
+        self.streams = {}
+        self.lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = collections.deque()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._pending)
+
+    def submit(self, stream_id, frame=None, k=0):
+        """
+        Queues a request of `stream_id`: feeds the observed `frame`, if any,
+        then predicts the next `k` frames.
+
+        Args:
+            stream_id: a hashable id of the stream.
+            frame: None, or a uint8 array of shape (H, W, C).
+            k: the number of frames to predict.
+
+        Returns:
+            A `Future` of the (k, H, W, C) uint8 array of the predicted
+            frames, or None if k is 0. A stream is registered by its first
+            frame, a request without a frame of an unknown stream fails
+            with a KeyError.
+        """
+        if frame is not None:
+            frame = np.asarray(frame)
+            if list(frame.shape) != self.image_shape or frame.dtype != np.uint8:
+                raise ValueError('Expected a uint8 frame of shape %r, but a %s frame of shape %r was given' %
+                                 (tuple(self.image_shape), frame.dtype, frame.shape))
+        if k < 0:
+            raise ValueError('Invalid k %d' % k)
+        request = Request(stream_id, frame, k)
+        self._queue.put(request)
+        return request.future
+
+    def reset(self, stream_id):
+        with self.lock:
+            return self.streams.pop(stream_id, None) is not None
+
+    def get_state(self, stream_id):
+        with self.lock:
+            return self.streams[stream_id].state_dict()
+
+    def set_state(self, stream_id, state_dict):
+        ### 接收其他 worker 交过来的流
+        with self.lock:
+            rollout = Rollout(self.model)
+            rollout.load_state_dict(state_dict)
+            self.streams[stream_id] = rollout
+
+    def _next_request(self, timeout):
+        if self._pending:
+            return self._pending.popleft()
+        return self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+
+    def _gather(self):
+        ### 等第一个请求，再等到 batch 满或者最早的请求到达 deadline
+        try:
+            first = self._next_request(timeout=0.1)
+        except queue.Empty:
+            return None
+        batch = [first]
+        stream_ids = {first.stream_id}
+        deferred = []
+        deadline = first.arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self._next_request(timeout=deadline - time.time())
+            except queue.Empty:
+                break
+            if request.stream_id in stream_ids:
+                ### 同一路流的请求按顺序处理，留到下一个 batch
+                deferred.append(request)
+            else:
+                batch.append(request)
+                stream_ids.add(request.stream_id)
+        self._pending.extendleft(reversed(deferred))
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._gather()
+            if batch is None:
+                continue
+            self.metrics.record_batch(len(batch), self.queue_depth)
+            try:
+                results = self._process(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            now = time.time()
+            for request, result in zip(batch, results):
+                self.metrics.record_latency(now - request.arrival_time)
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+        ### 停止后还在排队的请求
+        while True:
+            try:
+                request = self._next_request(timeout=0)
+            except queue.Empty:
+                break
+            request.future.set_exception(RuntimeError('The server was stopped'))
+
+    def _process(self, batch):
+        results = [None] * len(batch)
+        with self.lock, torch.no_grad():
+            frames = [request.frame for request in batch if request.frame is not None]
+            if frames:
+                ### NDHWC(uint8) -> DNCHW，整个 batch 一次拷贝到 device 上
+                frames = util.preprocess_images(torch.from_numpy(np.stack(frames))[:, None],
+                                                self.model.device, self.model.dtype)[0]
+                frames = iter(torch.split(frames, 1))
+            rollouts = []
+            for i, request in enumerate(batch):
+                if request.stream_id not in self.streams:
+                    ### 只有带帧的请求才建立新的流，只预测的请求不能凭空建立流
+                    if request.frame is None:
+                        results[i] = KeyError('Unknown stream %s' % request.stream_id)
+                        rollouts.append(None)
+                        continue
+                    self.streams[request.stream_id] = Rollout(self.model)
+                rollouts.append(self.streams[request.stream_id])
+
+            ### 还在输入 context 的流单独处理 (只是保存帧，或者展开一次 context)
+            step_inds = []
+            step_frames = []
+            for i, (request, rollout) in enumerate(zip(batch, rollouts)):
+                if request.frame is None:
+                    continue
+                frame = next(frames)
+                if rollout.started:
+                    step_inds.append(i)
+                    step_frames.append(frame)
+                else:
+                    rollout.step(frame)
+            batched = None
+            if step_inds:
+                batched = Rollout.concat([rollouts[i] for i in step_inds])
+                batched.step(torch.cat(step_frames))
+                for i, rollout in zip(step_inds, batched.split()):
+                    rollouts[i] = self.streams[batch[i].stream_id] = rollout
+
+            predict_inds = []
+            for i, (request, rollout) in enumerate(zip(batch, rollouts)):
+                if not request.k or rollout is None:
+                    continue
+                if rollout.started:
+                    predict_inds.append(i)
+                else:
+                    results[i] = ValueError('stream %s needs context_frames=%d frames, but only %d were given' %
+                                            (request.stream_id, self.model.hparams.context_frames,
+                                             rollout.num_frames))
+            if predict_inds:
+                if predict_inds != step_inds:
+                    batched = Rollout.concat([rollouts[i] for i in predict_inds])
+                k = max(batch[i].k for i in predict_inds)
+                gen_images = batched.predict(k)
+                ### (k, n, C, H, W) in [0, 1] -> (n, k, H, W, C) uint8
+                gen_images = (gen_images.float().clamp(0, 1) * 255).round().to(torch.uint8)
+                gen_images = gen_images.permute(1, 0, 3, 4, 2).cpu().numpy()
+                for j, i in enumerate(predict_inds):
+                    results[i] = gen_images[j, :batch[i].k]
+        return results
+
+
+def array_to_bytes(array):
+    f = io.BytesIO()
+    np.save(f, array, allow_pickle=False)
+    return f.getvalue()
+
+
+def array_from_bytes(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST   /streams/<id>/frames?k=<k>  body: a (H, W, C) uint8 .npy frame,
+                                       possibly empty to only predict.
+                                       returns the (k, H, W, C) uint8 .npy
+                                       predictions (empty if k is 0).
+    DELETE /streams/<id>               drops the state of the stream.
+    GET    /streams/<id>/state         the torch.save'd state of the stream.
+    PUT    /streams/<id>/state         loads a state saved by another server.
+    GET    /metrics                    the json metrics of the server.
+    """
+    STREAM_RE = re.compile(r'^/streams/([^/?]+)(/frames|/state)?(?:\?k=(\d+))?$')
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body=b'', content_type='application/octet-stream'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_message(self, code, message):
+        self.send(code, json.dumps({'error': message}).encode(), 'application/json')
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def match(self, suffix):
+        m = self.STREAM_RE.match(self.path)
+        if m is None or (m.group(2) or '') != suffix:
+            return None
+        return m
+
+    def do_GET(self):
+        server = self.server.inference_server
+        if self.path == '/metrics':
+            self.send(200, json.dumps(server.metrics.snapshot(server.queue_depth)).encode(), 'application/json')
+            return
+        m = self.match('/state')
+        if m is None:
+            self.send_error_message(404, 'Unknown path %s' % self.path)
+            return
+        try:
+            state_dict = server.get_state(m.group(1))
+        except KeyError:
+            self.send_error_message(404, 'Unknown stream %s' % m.group(1))
+            return
+        f = io.BytesIO()
+        torch.save(state_dict, f)
+        self.send(200, f.getvalue())
+
+    def do_PUT(self):
+        m = self.match('/state')
+        if m is None:
+            self.send_error_message(404, 'Unknown path %s' % self.path)
+            return
+        state_dict = torch.load(io.BytesIO(self.read_body()), map_location='cpu')
+        self.server.inference_server.set_state(m.group(1), state_dict)
+        self.send(204)
+
+    def do_DELETE(self):
+        m = self.match('')
+        if m is None:
+            self.send_error_message(404, 'Unknown path %s' % self.path)
+            return
+        self.send(204 if self.server.inference_server.reset(m.group(1)) else 404)
+
+    def do_POST(self):
+        m = self.match('/frames')
+        if m is None:
+            self.send_error_message(404, 'Unknown path %s' % self.path)
+            return
+        body = self.read_body()
+        try:
+            frame = array_from_bytes(body) if body else None
+            future = self.server.inference_server.submit(m.group(1), frame, int(m.group(3) or 0))
+            gen_images = future.result()
+        except KeyError:
+            self.send_error_message(404, 'Unknown stream %s' % m.group(1))
+            return
+        except ValueError as e:
+            self.send_error_message(400, str(e))
+            return
+        except Exception as e:
+            self.send_error_message(500, '%s: %s' % (type(e).__name__, e))
+            return
+        self.send(200, array_to_bytes(gen_images) if gen_images is not None else b'')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        ### HTTPServer.server_bind 会把地址当作 (host, port)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        return request, ('unix', 0)
+
+
+def make_http_server(inference_server, host='127.0.0.1', port=8000, unix_socket=None):
+    """
+    Returns the HTTP server of `inference_server`, listening on
+    `host:port`, or on the `unix_socket` path if given.
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        http_server = ThreadingUnixHTTPServer(unix_socket, InferenceRequestHandler)
+    else:
+        http_server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    http_server.inference_server = inference_server
+    return http_server
@@ -0,0 +1,139 @@
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_RE = re.compile(r'^model-(\d+)\.pt$')
+
+
+def to_cpu(state):
+    """
+    Returns a copy of the (nested dicts/lists of) tensors in `state` on the
+    cpu. The copy is never shared with the original tensors, so training can
+    keep updating them in-place while the copy is being serialized.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_steps(checkpoint_dir):
+    """
+    Returns the sorted steps of the `model-<step>.pt` checkpoints in
+    `checkpoint_dir`.
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    matches = [CHECKPOINT_RE.match(fname) for fname in os.listdir(checkpoint_dir)]
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    Returns the path of the checkpoint with the largest step in
+    `checkpoint_dir`, or None if there is none.
+    """
+    steps = checkpoint_steps(checkpoint_dir)
+    if not steps:
+        return None
+    return os.path.join(checkpoint_dir, 'model-%d.pt' % steps[-1])
+
+
+class CheckpointManager(object):
+    """
+    Writes the checkpoints `model-<step>.pt` of a training run without
+    stalling it.
+
+    `save` only takes a cpu snapshot of the state on the calling thread; the
+    serialization runs on a background thread. Every checkpoint is first
+    written to a temporary file and then atomically renamed, so a crash
+    never leaves a truncated `model-<step>.pt` behind, and only the last
+    `max_to_keep` checkpoints are kept. At most one write is in flight: a
+    `save` while the previous one is still being written waits for it.
+
+        manager = CheckpointManager(output_dir, max_to_keep=5)
+        manager.save(step, {'model': model.state_dict(), ...})
+        ...
+        manager.close()
+    """
+    def __init__(self, checkpoint_dir, max_to_keep=5):
+        """
+        Args:
+            checkpoint_dir: directory where the checkpoints are written.
+            max_to_keep: the number of most recent checkpoints to keep. 0 or
+                None keeps all of them.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        self._thread = None
+        self._exception = None
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def checkpoint_path(self, step):
+        return os.path.join(self.checkpoint_dir, 'model-%d.pt' % step)
+
+    def latest_checkpoint(self):
+        return latest_checkpoint(self.checkpoint_dir)
+
+    def _write(self, step, state):
+        try:
+            path = self.checkpoint_path(step)
+            tmp_path = '%s.tmp-%d' % (path, os.getpid())
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+            if self.max_to_keep:
+                for old_step in checkpoint_steps(self.checkpoint_dir)[:-self.max_to_keep]:
+                    os.remove(self.checkpoint_path(old_step))
+        except Exception as e:
+            self._exception = e
+
+    def save(self, step, state):
+        """
+        Snapshots `state` to the cpu and writes it in the background to
+        `model-<step>.pt`. Returns the path of the checkpoint.
+        """
+        self.wait()
+        snapshot = to_cpu(state)
+        self._thread = threading.Thread(target=self._write, args=(step, snapshot))
+        self._thread.start()
+        return self.checkpoint_path(step)
+
+    def wait(self):
+        """
+        Blocks until the pending write, if any, is done and re-raises its
+        exception.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._exception is not None:
+            exception, self._exception = self._exception, None
+            raise exception
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,148 @@
+"""
+A pure-Python replacement of `tf.contrib.training.HParams`, so that the
+datasets and the models can be imported without TensorFlow.
+
+Only the parts used by this repo are implemented, with the same semantics:
+the type of every hyperparameter is fixed by its default value, and
+`override_from_dict`/`parse` cast the new values to that type (ints are
+accepted for floats, but floats are not truncated to ints and strings are
+never turned into numbers or booleans).
+"""
+
+import json
+import numbers
+import re
+
+PARAM_RE = re.compile(r"""
+  (?P<name>[a-zA-Z][\w\.]*)      # variable name: "var" or "x"
+  \s*=\s*
+  ((?P<val>[^,\[]*)              # single value: "a" or None
+   |
+   \[(?P<vals>[^\]]*)\])         # list of values: None or "1,2,3"
+  ($|,\s*)""", re.VERBOSE)
+
+
+def _cast_to_type_if_compatible(name, param_type, value):
+    fail_msg = "Could not cast hparam '%s' of type '%s' from value %r" % (name, param_type, value)
+    if isinstance(value, param_type):
+        return value
+    # None defaults accept anything
+    if issubclass(param_type, type(None)):
+        return value
+    if issubclass(param_type, (str, bytes)) and not isinstance(value, (str, bytes)):
+        raise ValueError(fail_msg)
+    if issubclass(param_type, bool) != isinstance(value, bool):
+        raise ValueError(fail_msg)
+    if issubclass(param_type, numbers.Integral) and not isinstance(value, numbers.Integral):
+        raise ValueError(fail_msg)
+    if issubclass(param_type, numbers.Number) and not isinstance(value, numbers.Number):
+        raise ValueError(fail_msg)
+    return param_type(value)
+
+
+def _parse_value(name, param_type, value):
+    value = value.strip()
+    if issubclass(param_type, bool):
+        if value.lower() in ('true', '1'):
+            return True
+        if value.lower() in ('false', '0'):
+            return False
+        raise ValueError("Could not parse hparam '%s' of type bool from %r" % (name, value))
+    if issubclass(param_type, (str, type(None))):
+        return value
+    try:
+        return param_type(value)
+    except ValueError:
+        raise ValueError("Could not parse hparam '%s' of type '%s' from %r" % (name, param_type, value))
+
+
+class HParams(object):
+    """
+    Holds a set of hyperparameters as name-value attributes.
+
+        hparams = HParams(lr=0.001, kernel_size=(5, 5), gan_loss_type='LSGAN')
+        hparams.override_from_dict({'lr': 0.0002})
+        hparams.parse('kernel_size=[3,3],gan_loss_type=GAN')
+    """
+    def __init__(self, **kwargs):
+        self._hparam_types = {}
+        for name, value in kwargs.items():
+            self.add_hparam(name, value)
+
+    def add_hparam(self, name, value):
+        if getattr(self, name, None) is not None:
+            raise ValueError('Hyperparameter name is reserved: %s' % name)
+        if isinstance(value, (list, tuple)):
+            if not value:
+                raise ValueError('Multi-valued hyperparameters cannot be empty: %s' % name)
+            self._hparam_types[name] = (type(value[0]), True)
+        else:
+            self._hparam_types[name] = (type(value), False)
+        setattr(self, name, value)
+
+    def set_hparam(self, name, value):
+        """
+        Sets the value of an existing hyperparameter, casting it to the type
+        of the default value. Raises KeyError for unknown names and
+        ValueError for incompatible values.
+        """
+        param_type, is_list = self._hparam_types[name]
+        if isinstance(value, (list, tuple)):
+            if not is_list:
+                raise ValueError('Must not pass a list for single-valued parameter: %s' % name)
+            setattr(self, name, [_cast_to_type_if_compatible(name, param_type, v) for v in value])
+        else:
+            if is_list:
+                raise ValueError('Must pass a list for multi-valued parameter: %s' % name)
+            setattr(self, name, _cast_to_type_if_compatible(name, param_type, value))
+
+    def override_from_dict(self, values_dict):
+        for name, value in values_dict.items():
+            self.set_hparam(name, value)
+        return self
+
+    def parse(self, values):
+        """
+        Overrides hyperparameters from a string of comma separated
+        `name=value` pairs, e.g. "lr=0.0002,kernel_size=[3,3]".
+        """
+        values_dict = {}
+        pos = 0
+        while pos < len(values):
+            m = PARAM_RE.match(values, pos)
+            if not m:
+                raise ValueError('Malformed hyperparameter value: %s' % values[pos:])
+            pos = m.end()
+            name = m.group('name')
+            if name not in self._hparam_types:
+                raise ValueError('Unknown hyperparameter type for %s' % name)
+            if name in values_dict:
+                raise ValueError('Multiple assignments to variable \'%s\' in %s' % (name, values))
+            param_type, is_list = self._hparam_types[name]
+            if m.group('vals') is not None:
+                if not is_list:
+                    raise ValueError('Must not pass a list for single-valued parameter: %s' % name)
+                values_dict[name] = [_parse_value(name, param_type, v)
+                                     for v in m.group('vals').split(',') if v.strip()]
+            else:
+                if is_list:
+                    raise ValueError('Must pass a list for multi-valued parameter: %s' % name)
+                values_dict[name] = _parse_value(name, param_type, m.group('val'))
+        return self.override_from_dict(values_dict)
+
+    def values(self):
+        return {name: getattr(self, name) for name in self._hparam_types}
+
+    def get(self, key, default=None):
+        if key in self._hparam_types:
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key):
+        return key in self._hparam_types
+
+    def to_json(self, indent=None, separators=None, sort_keys=False):
+        return json.dumps(self.values(), indent=indent, separators=separators, sort_keys=sort_keys)
+
+    def __repr__(self):
+        return 'HParams(%s)' % ', '.join('%s=%r' % (name, value) for name, value in sorted(self.values().items()))
@@ -0,0 +1,182 @@
+import itertools
+import queue
+import threading
+import time
+
+import torch
+
+
+def to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return type(batch)((k, to_device(v, device, non_blocking)) for k, v in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(v, device, non_blocking) for v in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class _Error(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+class DevicePrefetcher(object):
+    """
+    Wraps a DataLoader and keeps up to `num_prefetch` batches already
+    resident on `device`.
+
+    A background thread pulls batches from the loader (so host collation
+    overlaps the training step) and copies them to the device. On CUDA the
+    copy is issued on a side stream, so it also overlaps the compute of the
+    previous step; the loader should use `pin_memory=True` for the copy to
+    be asynchronous.
+
+    If the sampler of the loader has `set_epoch` (e.g. a
+    `DistributedSampler`), it is called before every pass over the loader.
+
+    `epoch` and `batch` are the position of the batches returned so far
+    (not of the ones prefetched). `state_dict`/`load_state_dict` save and
+    restore it, so that a resumed run continues with the next batch, as
+    long as the order of the sampler only depends on the epoch. Samplers
+    with a `start_index` (`EpochSampler`) skip the consumed samples without
+    loading them.
+
+    `wait_time` is the time the last `next()` stalled waiting for data and
+    `total_wait_time` the sum over all the batches so far.
+    """
+    def __init__(self, loader, device, num_prefetch=2, num_epochs=1):
+        """
+        Args:
+            loader: an iterable of (nested dicts/lists of) tensors.
+            device: the device to move the batches to.
+            num_prefetch: the number of batches kept ready on the device.
+            num_epochs: number of passes over `loader`. None iterates
+                indefinitely.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.num_epochs = num_epochs
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.wait_time = 0.0
+        self.total_wait_time = 0.0
+        self.num_batches = 0
+        self.epoch = 0
+        self.batch = 0
+        self._start = (0, 0)
+        self._queue = None
+        self._stop = None
+        self._thread = None
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'batch': self.batch}
+
+    def load_state_dict(self, state_dict):
+        """
+        Makes the next pass start at the position of `state_dict`, instead
+        of at the beginning of the first epoch.
+        """
+        self.epoch, self.batch = state_dict['epoch'], state_dict['batch']
+        self._start = (self.epoch, self.batch)
+
+    def _worker(self, out_queue, stop, start_epoch, start_batch):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            epoch = start_epoch
+            sampler = getattr(self.loader, 'sampler', None)
+            while self.num_epochs is None or epoch < self.num_epochs:
+                num_skipped = start_batch
+                if hasattr(sampler, 'start_index'):
+                    sampler.set_epoch(epoch, start_index=start_batch * self.loader.batch_size)
+                    num_skipped = 0
+                elif hasattr(sampler, 'set_epoch'):
+                    # reshuffles a DistributedSampler
+                    sampler.set_epoch(epoch)
+                batches = itertools.islice(self.loader, num_skipped, None)
+                for i, batch in enumerate(batches, start_batch):
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            batch = to_device(batch, self.device, non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        batch = to_device(batch, self.device)
+                        event = None
+                    if not put((batch, event, epoch, i)):
+                        return
+                epoch += 1
+                start_batch = 0
+            put(_END)
+        except Exception as e:
+            put(_Error(e))
+
+    def __iter__(self):
+        self.close()
+        self._queue = queue.Queue(maxsize=self.num_prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, args=(self._queue, self._stop) + self._start,
+                                        daemon=True)
+        self._start = (0, 0)
+        self._thread.start()
+        return self
+
+    def __next__(self):
+        if self._thread is None:
+            iter(self)
+        start_time = time.time()
+        item = self._queue.get()
+        self.wait_time = time.time() - start_time
+        self.total_wait_time += self.wait_time
+        if item is _END:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _Error):
+            self.close()
+            raise item.exception
+        batch, event, self.epoch, self.batch = item
+        self.batch += 1
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # the memory was allocated on the side stream
+            _record_stream(batch, current_stream)
+        self.num_batches += 1
+        return batch
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+        self._thread = None
+
+    def __del__(self):
+        self.close()
@@ -4,14 +4,14 @@
 """
 
 import torch
-from tensorflow import broadcast_static_shape, TensorShape
+import torch.nn.functional as F
 
 ### savp_model.py 中 GeneratorGivenZ 使用 6/5
 def maybe_pad_or_slice(tensor, desired_length):
     ### 将 tensor 第 0 个维度调整至 desired_length 5/23
     length = list(tensor.shape)[0]
     if length < desired_length:
-        paddings = torch.zeros(size=[desired_length - length]+list(tensor.shape[1:]))
+        paddings = tensor.new_zeros(size=[desired_length - length]+list(tensor.shape[1:]))
         tensor = torch.cat((tensor, paddings), dim=0)
     elif length > desired_length:
         tensor = tensor[:desired_length]
@@ -19,6 +19,33 @@ def maybe_pad_or_slice(tensor, desired_length):
     return tensor
 
 
+def preprocess_images(images, device=None, dtype=torch.float32):
+    """
+    Moves a batch of images from the data loader to `device` and converts it
+    to the layout used by the models.
+
+    Args:
+        images: a `[batch, time, height, width, channels]` tensor, typically
+            uint8 (possibly in pinned memory).
+        device: the target device. None keeps the device of `images`.
+        dtype: the floating point type of the result.
+
+    Returns:
+        A contiguous `[time, batch, channels, height, width]` tensor of type
+        `dtype`. Integer images are scaled from [0, 255] to [0, 1]; floating
+        point images are assumed to be scaled already.
+    """
+    ### 只有 uint8 数据经过 PCIe，permute 和类型转换在 device 上由一次 copy_ 完成
+    images = images.to(device, non_blocking=True)
+    batch_size, sequence_length, height, width, channels = images.shape
+    outputs = torch.empty([sequence_length, batch_size, channels, height, width],
+                          dtype=dtype, device=images.device)
+    outputs.copy_(images.permute(1, 0, 4, 2, 3))
+    if not images.is_floating_point():
+        outputs.mul_(1.0 / torch.iinfo(images.dtype).max)
+    return outputs
+
+
 ### 暂时应该用不上 6/5
 def with_flat_batch(flat_batch_fn, ndims=4):
     ### 相当于一个装饰器 5/9
@@ -52,28 +79,44 @@ def tile_concat(values, axis):
     # remove axis dimension
     shapes = [list(s) for s in shapes]
     dims = [shape.pop(axis) for shape in shapes]   ### pop 会弹出/返回 axis 位置处的值, shape也会改变 5/26
-    shapes = [TensorShape(shape) for shape in shapes]   ### 来自 tf 6/2
     # compute broadcasted shape
-    b_shape = shapes[0]
-    for shape in shapes[1:]:
-        b_shape = broadcast_static_shape(b_shape, shape)  ### 来自 tf 6/2
+    b_shape = torch.broadcast_shapes(*shapes)
     # add back axis dimension
     b_shapes = [list(b_shape) for _ in dims]
     for b_shape, dim in zip(b_shapes, dims):
         b_shape.insert(axis, dim)
-    # tile values to match broadcasted shape, if necessary
-    b_values = []
-    for value, b_shape in zip(values, b_shapes):
-        multiples = []
-        for dim, b_dim in zip(list(value.shape), b_shape):
-            if dim == b_dim:
-                multiples.append(1)
-            else:
-                assert dim == 1
-                multiples.append(b_dim)
-        if any(multiple != 1 for multiple in multiples):
-            b_value = value.repeat(multiples)
-        else:
-            b_value = value
-        b_values.append(b_value)
-    return torch.cat(b_values, dim=axis)
\ No newline at end of file
+    # broadcast values to match broadcasted shape. expand only creates views, torch.cat
+    # reads them directly, so the tiled copies are never materialised
+    b_values = [value.expand(b_shape) for value, b_shape in zip(values, b_shapes)]
+    return torch.cat(b_values, dim=axis)
+
+
+def conv2d_tile_concat(conv, inputs, z, z_start):
+    """
+    Computes `conv(tile_concat([inputs[:, :z_start], z[:, :, None, None],
+    inputs[:, z_start:]], axis=1))` without tiling `z` over space.
+
+    The response of the conv to a spatially constant channel is the same
+    map everywhere except near the zero-padded borders, so it is computed
+    once from a map of ones (instead of once per sample) and mixed with `z`
+    by a matmul. This is a per-sample bias that is exact at the borders.
+
+    Args:
+        conv: a `nn.Conv2d` with groups=1 and zero padding.
+        inputs: a tensor of shape `[batch, in_channels - nz, height, width]`.
+        z: a tensor of shape `[batch, nz]`.
+        z_start: the channel of `conv`'s input where `z` would start.
+
+    Returns:
+        The output of `conv`.
+    """
+    assert conv.groups == 1 and conv.padding_mode == 'zeros'
+    weight = conv.weight
+    out_channels, nz = weight.shape[0], z.shape[1]
+    weight_inputs = torch.cat([weight[:, :z_start], weight[:, z_start + nz:]], dim=1)
+    weight_z = weight[:, z_start:z_start + nz].transpose(0, 1).reshape([nz * out_channels, 1] + list(weight.shape[2:]))
+    outputs = F.conv2d(inputs, weight_inputs, conv.bias, conv.stride, conv.padding, conv.dilation)
+    ones = inputs.new_ones([1, 1] + list(inputs.shape[2:]))
+    z_response = F.conv2d(ones, weight_z, None, conv.stride, conv.padding, conv.dilation)
+    z_response = z_response.reshape([nz, out_channels] + list(z_response.shape[2:]))
+    return outputs + torch.einsum('nc,cohw->nohw', z, z_response)